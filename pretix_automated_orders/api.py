@@ -0,0 +1,143 @@
+import json
+
+from django.http import StreamingHttpResponse
+from django.utils.timezone import make_aware
+from rest_framework import serializers, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from .forms import AutomatedBulkOrdersForm
+from .models import BulkOrderJob
+from .views import start_bulk_run
+
+# Number of result lines returned per page if the client does not ask for a different number, and the most
+# it may ask for.
+RESULTS_PAGE_SIZE = 1000
+RESULTS_MAX_PAGE_SIZE = 10000
+
+
+class BulkOrderJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BulkOrderJob
+        fields = ("id", "status", "total", "succeeded", "failed", "created", "started", "finished")
+
+
+def _result_page(job, after, errors_after, limit):
+    """
+    Returns up to ``limit`` results of ``job`` as dicts for JSON lines, together with
+    the cursors to fetch the next page with.
+
+    The results of the recipients come in the order of their ``position`` in the run
+    after ``after``: one line per created order and one per error. Chunks run in
+    parallel and commit their batches in any order, so while the job is running, a
+    page ends before the first position that has no result yet instead of skipping
+    it. Errors that affected the whole run have no position and come after the
+    recipients, in the order they were reported after the error ``errors_after``.
+    """
+    done = job.is_done
+    orders = [
+        {"type": "order", "position": position, "code": code, "email": email}
+        for position, code, email in job.rows.filter(row__gt=after).order_by("row").values_list(
+            "row", "order__code", "order__email"
+        )[:limit]
+    ]
+    errors = [
+        dict(error, type="error")
+        for error in job.errors.filter(position__gt=after).order_by("position", "pk").values(
+            "id", "position", "row", "email", "error"
+        )[:limit]
+    ]
+    lines = []
+    for line in sorted(orders + errors, key=lambda line: (line["position"], line["type"] == "error")):
+        # Lines of the same position are never split between pages, the cursor would skip the rest.
+        if line["position"] > after and (len(lines) >= limit or (line["position"] > after + 1 and not done)):
+            break
+        lines.append(line)
+        after = line["position"]
+    if done:
+        for error in job.errors.filter(position__isnull=True, pk__gt=errors_after).values(
+            "id", "position", "row", "email", "error"
+        )[:max(0, limit - len(lines))]:
+            lines.append(dict(error, type="error"))
+            errors_after = error["id"]
+    return lines, after, errors_after
+
+
+class BulkOrderJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Starts bulk runs and reports their progress and results.
+
+    A run is started by posting the same fields the form in the backend has, with
+    the recipients given as a list of objects with the keys of the CSV columns in
+    ``recipients``, as CSV text in ``send_recipients`` or as a CSV file uploaded as
+    ``send_recipients_file``. ``scheduled_start`` is an ISO 8601 date and time. The
+    response contains the job, whose results can be fetched as newline-delimited JSON
+    from the ``results`` endpoint in pages of up to ``limit`` lines. Every line has the
+    ``position`` of its recipient in the run, error lines also their ``row`` in the
+    list. The ``next`` link continues after the last line of the page and is there
+    as long as the job is running or more lines are left.
+    """
+
+    serializer_class = BulkOrderJobSerializer
+    queryset = BulkOrderJob.objects.none()
+    permission = "can_view_orders"
+    write_permission = "can_change_orders"
+
+    def get_queryset(self):
+        return BulkOrderJob.objects.filter(event=self.request.event)
+
+    def _recipients(self):
+        if "recipients" not in self.request.data:
+            return None
+        recipients = self.request.data["recipients"]
+        if not isinstance(recipients, list):
+            raise ValidationError({"recipients": ["Expected a list of recipients."]})
+        if not all(isinstance(r, dict) for r in recipients):
+            raise ValidationError({"recipients": ["Every recipient needs to be an object."]})
+        return recipients
+
+    def _form_data(self):
+        data = {k: v for k, v in self.request.data.items() if k not in ("send_recipients_file", "recipients")}
+        if data.get("scheduled_start"):
+            start = serializers.DateTimeField().to_internal_value(data.pop("scheduled_start"))
+            if start.tzinfo is None:
+                start = make_aware(start, self.request.event.timezone)
+            start = start.astimezone(self.request.event.timezone)
+            data["scheduled_start_0"] = start.date().isoformat()
+            data["scheduled_start_1"] = start.time().isoformat()
+        return data
+
+    def create(self, request, *args, **kwargs):
+        form = AutomatedBulkOrdersForm(
+            data=self._form_data(), files=request.FILES, event=request.event, recipients=self._recipients()
+        )
+        if not form.is_valid():
+            raise ValidationError(form.errors)
+        job = start_bulk_run(form, request.event, request.user)
+        job.refresh_from_db()
+        return Response(self.get_serializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=["get"])
+    def results(self, request, *args, **kwargs):
+        job = self.get_object()
+        try:
+            after = max(-1, int(request.query_params.get("after", -1)))
+            errors_after = max(0, int(request.query_params.get("errors_after", 0)))
+            limit = min(RESULTS_MAX_PAGE_SIZE, max(1, int(request.query_params.get("limit", RESULTS_PAGE_SIZE))))
+        except ValueError:
+            raise ValidationError("after, errors_after and limit need to be numbers.")
+        lines, after, errors_after = _result_page(job, after, errors_after, limit)
+        response = StreamingHttpResponse(
+            (json.dumps(line) + "\n" for line in lines), content_type="application/x-ndjson"
+        )
+        if not job.is_done or len(lines) >= limit:
+            query = request.query_params.copy()
+            query["after"] = after
+            query["errors_after"] = errors_after
+            query["limit"] = limit
+            response["Link"] = '<{}>; rel="next"'.format(
+                request.build_absolute_uri("?" + query.urlencode())
+            )
+        response["X-Job-Status"] = job.status
+        return response
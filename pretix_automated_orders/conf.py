@@ -0,0 +1,39 @@
+"""
+Server-wide settings of the plugin, read from the ``[automated_orders]`` section
+of pretix.cfg or the matching ``PRETIX_AUTOMATED_ORDERS_*`` environment variables.
+"""
+from django.conf import settings
+
+SECTION = "automated_orders"
+
+config = settings.CONFIG_FILE
+
+# Celery queue for queued notification mails, and the rate (e.g. "10/s") at which all mail tasks together send
+# them. The tasks wait between mails, so the queue is one of its own rather than pretix' mail queue.
+MAIL_QUEUE = config.get(SECTION, "mail_queue", fallback="automated_orders_mail")
+MAIL_RATE_LIMIT = config.get(SECTION, "mail_rate_limit", fallback=None) or None
+# Number of orders whose notifications are sent by one mail task at most. The mails of every batch of orders are
+# queued once it is placed, so a task never gets more than ORDER_BATCH_SIZE orders.
+MAIL_BATCH_SIZE = config.getint(SECTION, "mail_batch_size", fallback=50)
+# Celery queue for the order_placed/order_paid signals of runs that defer them.
+SIGNAL_QUEUE = config.get(SECTION, "signal_queue", fallback="background")
+# Number of orders that are committed in one database transaction. The quotas of the orders stay locked until the
+# transaction commits, so shop customers buying from them wait for the whole batch.
+ORDER_BATCH_SIZE = config.getint(SECTION, "order_batch_size", fallback=10)
+# Number of tasks that render the invoice PDFs of a run in parallel, if they are deferred.
+INVOICE_PDF_CONCURRENCY = config.getint(SECTION, "invoice_pdf_concurrency", fallback=4)
+# Time the stages of each bulk run and store the summary on the job. With metrics, the
+# times are also added to pretix' metrics endpoint.
+TIMINGS = config.getboolean(SECTION, "timings", fallback=False)
+METRICS = config.getboolean(SECTION, "metrics", fallback=False)
+# Celery queue of the tasks that create the orders of bulk runs. Point it to a queue of its own to keep bulk
+# runs away from the workers that serve pretix' interactive tasks.
+BULK_QUEUE = config.get(SECTION, "bulk_queue", fallback="background")
+# Number of bulk runs of one organizer that may run at the same time, 0 for no limit. Only one run per
+# event runs at a time regardless. Runs that have to wait are tried again every ``job_retry_delay`` seconds. A run
+# that failed counts as running until its remaining chunks have ended.
+MAX_JOBS_PER_ORGANIZER = config.getint(SECTION, "max_jobs_per_organizer", fallback=2)
+JOB_RETRY_DELAY = config.getint(SECTION, "job_retry_delay", fallback=60)
+# A running job that has not reported progress for this many seconds, e.g. because its worker died, is marked as
+# failed once another run wants to start. A spread run counts as reporting progress until the end of its window.
+JOB_STALE_AFTER = config.getint(SECTION, "job_stale_after", fallback=1800)
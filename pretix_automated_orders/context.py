@@ -0,0 +1,136 @@
+from collections import namedtuple
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.utils.translation import gettext as _
+from pretix.api.serializers.order import OrderCreateSerializer
+from pretix.base.models import Order
+from pretix.base.services.quotas import QuotaAvailability
+
+from . import conf
+from .timing import StageTimer
+
+MailTemplates = namedtuple(
+    "MailTemplates",
+    "text subject log_entry attendees attendee_text attendee_subject",
+)
+
+
+class BulkOrderContext:
+    """
+    Everything about an event that is the same for every order of a bulk run.
+
+    Built once before the recipient loop, so reading the event settings, resolving
+    the mail templates and looking up the product happen once per run instead of
+    once per order.
+    """
+
+    def __init__(self, event, user=None, product_id=None):
+        self.event = event
+        self.user = user if user is not None and user.is_authenticated else None
+        self.item = event.items.get(pk=product_id) if product_id is not None else None
+        self._order_templates = {}
+        # Orders the fast path copies, by number of tickets, see fastpath.py.
+        self.prototypes = {}
+        self.timer = StageTimer(conf.TIMINGS)
+
+        settings = event.settings
+        self.region = settings.region
+        self.locale = settings.locale
+        self.invoice_generate = settings.get("invoice_generate")
+        self.invoice_email_attachment = settings.invoice_email_attachment
+        self.mail_send_order_paid_attendee = settings.mail_send_order_paid_attendee
+        self.mails_require_approval = MailTemplates(
+            text=settings.mail_text_order_placed_require_approval,
+            subject=settings.mail_subject_order_placed_require_approval,
+            log_entry="pretix.event.order.email.order_placed_require_approval",
+            attendees=False,
+            attendee_text=None,
+            attendee_subject=None,
+        )
+        self.mails_free = MailTemplates(
+            text=settings.mail_text_order_free,
+            subject=settings.mail_subject_order_free,
+            log_entry="pretix.event.order.email.order_free",
+            attendees=settings.mail_send_order_free_attendee,
+            attendee_text=settings.mail_text_order_free_attendee,
+            attendee_subject=settings.mail_subject_order_free_attendee,
+        )
+        self.mails_placed = MailTemplates(
+            text=settings.mail_text_order_placed,
+            subject=settings.mail_subject_order_placed,
+            log_entry="pretix.event.order.email.order_placed",
+            attendees=settings.mail_send_order_placed_attendee,
+            attendee_text=settings.mail_text_order_placed_attendee,
+            attendee_subject=settings.mail_subject_order_placed_attendee,
+        )
+
+    def invoice_wanted(self, order):
+        return self.invoice_generate == "True" or (
+            self.invoice_generate == "paid" and order.status == Order.STATUS_PAID
+        )
+
+    def validate(self, count):
+        """
+        Checks once for the whole run what ``OrderCreateSerializer`` would otherwise
+        check for every single order, and raises a ``ValidationError`` listing every
+        problem before any order is written. ``count`` is the number of positions the
+        run will create.
+        """
+        errors = []
+        item = self.item
+        if item.default_price != Decimal("0.00"):
+            errors.append(_('The product "{item}" is not free.').format(item=item))
+        if item.has_variations:
+            errors.append(_('The product "{item}" has variations, which is not supported.').format(item=item))
+
+        sales_channel = self.event.organizer.sales_channels.filter(identifier="web").first()
+        if sales_channel is None:
+            errors.append(_('The sales channel "{channel}" does not exist.').format(channel="web"))
+        elif not item.all_sales_channels and not item.limit_sales_channels.filter(pk=sales_channel.pk).exists():
+            errors.append(_('The product "{item}" is not available in the sales channel "{channel}".').format(
+                item=item, channel="web"
+            ))
+
+        provider = self.event.get_payment_providers().get("free")
+        if provider is None or not provider.is_enabled:
+            errors.append(_("The free payment provider is not available for this event."))
+
+        quotas = list(item.quotas.filter(subevent=None))
+        if not quotas:
+            errors.append(_('The product "{item}" is not assigned to a quota.').format(item=item))
+        else:
+            qa = QuotaAvailability()
+            qa.queue(*quotas)
+            qa.compute()
+            for quota in quotas:
+                available = qa.results[quota][1]
+                if available is not None and available < count:
+                    errors.append(_(
+                        'There is only quota for {available} of {count} tickets on quota "{quota}".'
+                    ).format(available=available, count=count, quota=quota.name))
+
+        if errors:
+            raise ValidationError(errors)
+
+    def order_data(self, data):
+        """
+        Returns validated data for ``OrderCreateSerializer.create``.
+
+        Only the first order of a run with a given number of tickets goes through the
+        full serializer validation. All later orders have the same product, channel
+        and payment provider and only differ in the customer and locale, so they
+        reuse the validated data of the first one with those fields swapped in.
+        """
+        size = len(data["positions"])
+        if size not in self._order_templates:
+            serializer = OrderCreateSerializer(data=data, context={"event": self.event})
+            serializer.is_valid(raise_exception=True)
+            self._order_templates[size] = serializer.validated_data
+        template = self._order_templates[size]
+        validated_data = dict(template, email=data["email"], locale=data["locale"])
+        validated_data["positions"] = [
+            dict(tp, attendee_name=p["attendee_name"], attendee_email=p["attendee_email"])
+            for tp, p in zip(template["positions"], data["positions"])
+        ]
+        return validated_data
@@ -0,0 +1,195 @@
+"""
+Creates many orders of the same shape with a handful of bulk inserts.
+
+The first order of a run with a given number of tickets is placed through
+``OrderCreateSerializer`` as usual and becomes the prototype. Every further order
+of that shape is a copy of the prototype's order, positions, payments and
+transactions with only the per-order values replaced: customer, codes, secrets and
+timestamps. The results are therefore the same as with the serializer, but the
+rows of a whole batch are inserted together and all uniqueness checks run as one
+query per batch instead of one per order.
+"""
+import copy
+
+from django.conf import settings
+from django.db import connections
+from django.utils.crypto import get_random_string
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.banlist import banned
+from pretix.base.models import Order, OrderPayment, OrderPosition, Transaction
+from pretix.base.models.orders import generate_secret
+from pretix.base.secrets import assign_ticket_secret
+from pretix.base.services.locking import lock_objects
+from pretix.base.services.quotas import QuotaAvailability
+
+from .models import BulkOrderJobRow
+
+# The same characters Order.assign_code and OrderPosition.assign_pseudonymization_id use.
+ORDER_CODE_CHARSET = "ABCDEFGHJKLMNPQRSTUVWXYZ379"
+PSEUDONYMIZATION_ID_CHARSET = "ABCDEFGHJKLMNPQRSTUVWXYZ3789"
+
+
+class FastPathUnavailable(Exception):
+    """
+    Raised if a batch can not be created by copying the prototype, e.g. because the
+    quota does not suffice. The orders then go through the serializer one by one,
+    which reports the problem per recipient.
+    """
+
+
+class OrderPrototype:
+    def __init__(self, order, send_mail):
+        self.order = order
+        self.send_mail = send_mail
+        self.positions = list(order.positions.all())
+        self.payments = list(order.payments.all())
+        self.transactions = list(Transaction.objects.filter(order=order))
+        self.quotas = list(
+            order.event.quotas.filter(items__in={p.item_id for p in self.positions}, subevent=None).distinct()
+        )
+        if not connections["default"].features.can_return_rows_from_bulk_insert:
+            raise FastPathUnavailable()
+        if any(p.addon_to_id or p.seat_id or p.voucher_id for p in self.positions) or order.fees.exists():
+            raise FastPathUnavailable()
+
+
+def _copy(instance, exclude):
+    return type(instance)(**{
+        f.attname: copy.deepcopy(getattr(instance, f.attname))
+        for f in instance._meta.concrete_fields
+        if f.attname not in exclude
+    })
+
+
+def _order_codes(organizer, count, testmode):
+    """
+    Generates ``count`` order codes that are not used by any order of the organizer,
+    like ``Order.assign_code`` but with one query per round instead of one per code.
+    """
+    length = settings.ENTROPY["order_code"]
+    codes = set()
+    rounds = 0
+    while len(codes) < count:
+        candidates = set()
+        while len(candidates) < count - len(codes):
+            code = get_random_string(length=length, allowed_chars=ORDER_CODE_CHARSET)
+            if banned(code):
+                continue
+            if testmode:
+                code = code[0] + "0" + code[2:]
+            if code not in codes:
+                candidates.add(code)
+        candidates -= set(Order.objects.filter(event__organizer=organizer, code__in=candidates).values_list("code", flat=True))
+        codes |= candidates
+        rounds += 1
+        if rounds > 20:
+            length += 1
+            rounds = 0
+    return list(codes)
+
+
+def _assign_secrets(event, positions):
+    used = set()
+    todo = positions
+    while todo:
+        for p in todo:
+            assign_ticket_secret(event=event, position=p, force_invalidate=True, save=False)
+        with scopes_disabled():
+            taken = set(OrderPosition.all.filter(
+                secret__in=[p.secret for p in todo], order__event__organizer_id=event.organizer_id
+            ).values_list("secret", flat=True))
+        retry = []
+        for p in todo:
+            if p.secret in taken or p.secret in used:
+                retry.append(p)
+            else:
+                used.add(p.secret)
+        todo = retry
+
+
+def _assign_pseudonymization_ids(positions):
+    ids = set()
+    while len(ids) < len(positions):
+        candidates = {
+            get_random_string(length=10, allowed_chars=PSEUDONYMIZATION_ID_CHARSET)
+            for i in range(len(positions) - len(ids))
+        } - ids
+        with scopes_disabled():
+            candidates -= set(OrderPosition.all.filter(
+                pseudonymization_id__in=candidates
+            ).values_list("pseudonymization_id", flat=True))
+        ids |= candidates
+    for p, pseudonymization_id in zip(positions, ids):
+        p.pseudonymization_id = pseudonymization_id
+
+
+def create_orders(ctx, prototype, items, job_id=None):
+    """
+    Creates one order per entry of ``items``, a list of ``(key, data)`` pairs with
+    ``data`` being the order data as passed to the serializer, by copying
+    ``prototype``. Needs to run in a transaction. Returns the orders in the order of
+    ``items``.
+    """
+    event = ctx.event
+    dt = now()
+
+    needed = len(items) * len(prototype.positions)
+    lock_objects([q for q in prototype.quotas if q.size is not None], shared_lock_objects=[event])
+    qa = QuotaAvailability()
+    qa.queue(*prototype.quotas)
+    qa.compute()
+    if any(qa.results[q][1] is not None and qa.results[q][1] < needed for q in prototype.quotas):
+        raise FastPathUnavailable()
+
+    orders = []
+    codes = _order_codes(event.organizer, len(items), prototype.order.testmode)
+    for (key, data), code in zip(items, codes):
+        order = _copy(prototype.order, ("id", "code", "email", "locale", "secret", "internal_secret", "datetime"))
+        order.event = event
+        order.code = code
+        order.email = data["email"]
+        order.locale = data.get("locale") or prototype.order.locale
+        order.secret = generate_secret()
+        order.internal_secret = generate_secret()
+        order.datetime = dt
+        orders.append(order)
+    Order.objects.bulk_create(orders)
+
+    positions = []
+    payments = []
+    transactions = []
+    for order, (key, data) in zip(orders, items):
+        for proto, pos_data in zip(prototype.positions, data["positions"]):
+            pos = _copy(proto, (
+                "id", "order_id", "attendee_name_cached", "attendee_name_parts", "attendee_email", "secret",
+                "web_secret", "pseudonymization_id"
+            ))
+            pos.order = order
+            name = pos_data.get("attendee_name")
+            pos.attendee_name_parts = {"_legacy": name} if name else {}
+            pos.attendee_name_cached = pos.attendee_name
+            pos.attendee_email = pos_data.get("attendee_email")
+            pos.web_secret = generate_secret()
+            positions.append(pos)
+        for proto in prototype.payments:
+            payment = _copy(proto, ("id", "order_id", "created", "payment_date"))
+            payment.order = order
+            payment.payment_date = dt
+            payments.append(payment)
+        for proto in prototype.transactions:
+            t = _copy(proto, ("id", "order_id", "created", "datetime"))
+            t.order = order
+            t.datetime = dt
+            transactions.append(t)
+    _assign_secrets(event, positions)
+    _assign_pseudonymization_ids(positions)
+    OrderPosition.objects.bulk_create(positions)
+    OrderPayment.objects.bulk_create(payments)
+    Transaction.objects.bulk_create(transactions)
+
+    if job_id is not None:
+        BulkOrderJobRow.objects.bulk_create(
+            BulkOrderJobRow(job_id=job_id, row=key, order=order) for order, (key, data) in zip(orders, items)
+        )
+    return orders
@@ -1,13 +1,76 @@
-import csv
-from collections import namedtuple
+from functools import partial
 from io import StringIO
 
 from django import forms
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.core.validators import EmailValidator
-from django.utils.translation import gettext_lazy as _
+from django.db import connection
+from django.utils.timezone import now
+from django.utils.translation import get_language, gettext_lazy as _
+from pretix.base.forms.widgets import SplitDateTimePickerWidget
 from pretix.base.models import Item
 from pretix.base.models.orders import Order
+from pretix.control.forms import SplitDateTimeField
+
+from .context import BulkOrderContext
+from .recipients import Recipient, RecipientValidator, open_recipient_file
+
+ELIGIBLE_ITEMS_CACHE_TTL = 300
+
+
+def _eligible_items_key(event_id):
+    return "automated_orders:eligible_items:{}".format(event_id)
+
+
+def eligible_items(event):
+    if event is None:
+        return Item.objects.none()
+    return Item.objects.filter(event=event, default_price=0)
+
+
+def eligible_item_choices(event):
+    """
+    Returns the free products of ``event`` as choices of ids and names in the active
+    language, so the form can be rendered without a query. The choices are cached per
+    event and dropped whenever one of the event's products is saved or deleted.
+    """
+    if event is None:
+        return []
+    key = _eligible_items_key(event.pk)
+    # The names depend on the language, so the choices of every language are stored under the event's key.
+    choices = cache.get(key) or {}
+    language = get_language()
+    if language not in choices:
+        choices[language] = [(item.pk, str(item)) for item in eligible_items(event)]
+        cache.set(key, choices, ELIGIBLE_ITEMS_CACHE_TTL)
+    return choices[language]
+
+
+def invalidate_eligible_items(event_id):
+    cache.delete(_eligible_items_key(event_id))
+
+
+def existing_order_emails(event, emails):
+    """
+    Returns the lowercased addresses among ``emails`` that already have a pending or
+    paid order in ``event``. The addresses are looked up as written and in lower case.
+    """
+    candidates = list(set(emails) | {e.lower() for e in emails})
+    if not candidates:
+        return set()
+    # Written out by hand: with a thousand addresses per lookup, the ORM takes several times as long to prepare
+    # the parameters of email__in as the database takes to answer the query.
+    qn = connection.ops.quote_name
+    sql = "SELECT {email} FROM {table} WHERE {event} = %s AND {status} IN (%s, %s) AND {email} IN ({params})".format(
+        email=qn(Order._meta.get_field("email").column),
+        table=qn(Order._meta.db_table),
+        event=qn(Order._meta.get_field("event").column),
+        status=qn(Order._meta.get_field("status").column),
+        params=", ".join(["%s"] * len(candidates)),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [event.pk, Order.STATUS_PENDING, Order.STATUS_PAID] + candidates)
+        return {email.lower() for email, in cursor.fetchall()}
 
 
 class AutomatedBulkOrdersForm(forms.ModelForm):
@@ -28,12 +91,101 @@ class AutomatedBulkOrdersForm(forms.ModelForm):
                 )
             }
         ),
-        required=True,
+        required=False,
         initial="email,name\n",
         help_text=_(
             f"You can either supply a list of email addresses with one email address per line, or a CSV file with a title column "
             'and one or more of the columns:'
-        ) + ' "email", "name"',
+        ) + ' "email", "name", "number", "locale"',
+    )
+    send_recipients_file = forms.FileField(
+        label=_("Recipients file"),
+        required=False,
+        help_text=_(
+            "Alternatively, upload the recipient list as a UTF-8 encoded CSV or text file. "
+            "Use this for large lists."
+        ),
+    )
+    allow_duplicates = forms.BooleanField(
+        label=_("Allow duplicate recipients"),
+        required=False,
+        help_text=_(
+            "By default, email addresses that are listed more than once or that already have an order "
+            "for this event are reported as errors."
+        ),
+    )
+    chunk_size = forms.IntegerField(
+        label=_("Chunk size"),
+        min_value=1,
+        initial=500,
+        required=False,
+        help_text=_(
+            "Large recipient lists are split into chunks of this size that are processed in parallel. "
+            "Leave empty to process all recipients in a single background task."
+        ),
+    )
+
+    defer_mails = forms.BooleanField(
+        label=_("Queue notification emails"),
+        required=False,
+        help_text=_(
+            "Create all orders first and send the notification emails in rate-limited batches "
+            "from a separate mail queue."
+        ),
+    )
+
+    defer_invoice_pdfs = forms.BooleanField(
+        label=_("Render invoices afterwards"),
+        required=False,
+        help_text=_(
+            "Create the invoices together with the orders, but render their PDF files in parallel "
+            "once all orders are placed. Emails with an invoice attached wait for their PDF."
+        ),
+    )
+
+    defer_signals = forms.BooleanField(
+        label=_("Notify other plugins afterwards"),
+        required=False,
+        help_text=_(
+            "Send the order notifications to other plugins, e.g. webhooks, in batches from a background "
+            "task after the orders are saved, so slow plugins do not slow down creating the orders."
+        ),
+    )
+
+    fast_path = forms.BooleanField(
+        label=_("Fast mode"),
+        required=False,
+        help_text=_(
+            "Create the orders in bulk by copying the first order with the same number of tickets. "
+            "Recommended for large lists."
+        ),
+    )
+
+    scheduled_start = SplitDateTimeField(
+        label=_("Start at"),
+        required=False,
+        widget=SplitDateTimePickerWidget(),
+        help_text=_("Leave empty to start right away. The time is in the timezone of the event."),
+    )
+    spread_minutes = forms.IntegerField(
+        label=_("Spread over (minutes)"),
+        min_value=1,
+        required=False,
+        help_text=_(
+            "Distribute the start of the chunks evenly over this many minutes instead of processing them all "
+            "at once. Requires a chunk size."
+        ),
+    )
+
+    number_mode = forms.ChoiceField(
+        label=_("Number column"),
+        choices=(
+            ("positions", _("Create one order with that many tickets")),
+            ("orders", _("Create that many separate orders")),
+        ),
+        initial="positions",
+        required=False,
+        help_text=_('How the optional "number" column of the recipient list is applied.'),
     )
 
     class Meta:
@@ -41,93 +193,86 @@ class AutomatedBulkOrdersForm(forms.ModelForm):
         fields = [
             "product",
             "send_recipients",
+            "send_recipients_file",
+            "allow_duplicates",
+            "chunk_size",
+            "defer_mails",
+            "defer_invoice_pdfs",
+            "defer_signals",
+            "fast_path",
+            "scheduled_start",
+            "spread_minutes",
+            "number_mode",
         ]
 
     def __init__(self, *args, **kwargs):
         event = None
         if "event" in kwargs:
             event = kwargs.pop("event")
+        # Recipients that are already split into fields, see RecipientValidator.iter_records. They take the
+        # place of the recipients entered as text.
+        self._recipient_records = kwargs.pop("recipients", None)
         super().__init__(*args, **kwargs)
-        self.fields["product"].queryset = Item.objects.filter(event=event, default_price=0)
+        self._event = event
+        product = self.fields["product"]
+        product.queryset = eligible_items(event)
+        product.choices = [("", product.empty_label)] + eligible_item_choices(event)
 
-    Recipient = namedtuple("Recipient", "email number name tag")
+    Recipient = Recipient
+
+    def _recipient_validator(self):
+        allow_duplicates = self.fields["allow_duplicates"].clean(self["allow_duplicates"].data)
+        existing_emails = None
+        if not allow_duplicates and self._event is not None:
+            existing_emails = partial(existing_order_emails, self._event)
+        return RecipientValidator(
+            existing_emails=existing_emails,
+            allow_duplicates=allow_duplicates,
+            locales=self._event.settings.locales if self._event is not None else None,
+        )
 
     def clean_send_recipients(self):
         raw = self.cleaned_data["send_recipients"]
-        if not raw:
+        if self._recipient_records is None and not raw:
             return []
-        r = raw.split("\n")
-        res = []
-        if "," in raw or ";" in raw:
-            if "@" in r[0]:
-                raise ValidationError(
-                    _("CSV input needs to contain a header row in the first line.")
-                )
-            try:
-                dialect = csv.Sniffer().sniff(raw[:1024])
-                reader = csv.DictReader(StringIO(raw), dialect=dialect)
-            except csv.Error as e:
-                raise ValidationError(
-                    _("CSV parsing failed: {error}.").format(error=str(e))
-                )
-            if "email" not in reader.fieldnames:
-                raise ValidationError(
-                    _(
-                        'CSV input needs to contain a field with the header "{header}".'
-                    ).format(header="email")
-                )
-            unknown_fields = [
-                f
-                for f in reader.fieldnames
-                if f not in ("email", "name", "tag", "number")
-            ]
-            if unknown_fields:
-                raise ValidationError(
-                    _(
-                        'CSV input contains an unknown field with the header "{header}".'
-                    ).format(header=unknown_fields[0])
-                )
-            for i, row in enumerate(reader):
-                try:
-                    EmailValidator()(row["email"])
-                except ValidationError as err:
-                    raise ValidationError(
-                        _("{value} is not a valid email address.").format(
-                            value=row["email"]
-                        )
-                    ) from err
-                try:
-                    res.append(
-                        self.Recipient(
-                            name=row.get("name", ""),
-                            email=row["email"].strip(),
-                            number=int(row.get("number", 1)),
-                            tag=row.get("tag", None),
-                        )
-                    )
-                except ValueError as err:
-                    raise ValidationError(
-                        _("Invalid value in row {number}.").format(number=i + 1)
-                    ) from err
+        validator = self._recipient_validator()
+        if self._recipient_records is not None:
+            res = list(validator.iter_records(self._recipient_records))
         else:
-            for e in r:
-                try:
-                    EmailValidator()(e.strip())
-                except ValidationError as err:
-                    raise ValidationError(
-                        _("{value} is not a valid email address.").format(
-                            value=e.strip()
-                        )
-                    ) from err
-                else:
-                    res.append(
-                        self.Recipient(email=e.strip(), number=1, tag=None, name="")
-                    )
+            res = list(validator.iter(StringIO(raw)))
+        validator.raise_errors()
         return res
 
+    def clean_send_recipients_file(self):
+        upload = self.cleaned_data.get("send_recipients_file")
+        if not upload:
+            return None
+        # The file is only streamed through the validator to check it and count its rows, the recipients
+        # themselves are read again by the worker.
+        validator = self._recipient_validator()
+        stream = open_recipient_file(upload.file)
+        try:
+            for r in validator.iter(stream):
+                pass
+        except UnicodeDecodeError:
+            raise ValidationError(_("The uploaded file needs to be encoded as UTF-8."))
+        finally:
+            stream.detach()
+        validator.raise_errors()
+        if not validator.rows:
+            raise ValidationError(_("The uploaded file does not contain any recipients."))
+        self.file_rows = validator.rows
+        self.file_tickets = validator.tickets
+        return upload
+
     def clean(self):
         data = super().clean()
 
+        if data.get("scheduled_start") and data["scheduled_start"] < now():
+            raise ValidationError(_("The start needs to be in the future."))
+        if data.get("spread_minutes") and not data.get("chunk_size"):
+            raise ValidationError(_("A run can only be spread over time if it is split into chunks."))
+
         if data.get("send") and not all([data.get("send_recipients")]):
             raise ValidationError(
                 _("If orders should be sent by email, recipients need to be specified.")
@@ -144,4 +289,20 @@ class AutomatedBulkOrdersForm(forms.ModelForm):
                     ).format(codes=code_len, recp=recp_len)
                 )
 
+        if data.get("send_recipients_file"):
+            if data.get("send_recipients"):
+                raise ValidationError(
+                    _("Please either enter the recipients or upload a file, not both.")
+                )
+            tickets = self.file_tickets
+        elif data.get("send_recipients"):
+            tickets = sum(r.number for r in data["send_recipients"])
+        else:
+            if "send_recipients" in data and "send_recipients_file" in data:
+                raise ValidationError(_("Please enter the recipients or upload a file."))
+            return data
+
+        if data.get("product"):
+            BulkOrderContext(self._event, product_id=data["product"].pk).validate(tickets)
+
         return data
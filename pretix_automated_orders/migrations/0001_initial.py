@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pretixbase', '0246_bigint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkOrderJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('status', models.CharField(default='pending', max_length=16)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('succeeded', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('errors', models.JSONField(default=list)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='automated_order_jobs', to='pretixbase.event')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-created',),
+            },
+        ),
+    ]
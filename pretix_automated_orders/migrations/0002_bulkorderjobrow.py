@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretixbase', '0246_bigint'),
+        ('pretix_automated_orders', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkOrderJobRow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('row', models.PositiveIntegerField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rows', to='pretix_automated_orders.bulkorderjob')),
+                ('order', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='pretixbase.order')),
+            ],
+            options={
+                'ordering': ('job', 'row'),
+                'unique_together': {('job', 'row')},
+            },
+        ),
+    ]
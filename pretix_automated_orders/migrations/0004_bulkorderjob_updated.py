@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_automated_orders', '0003_bulkorderjob_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulkorderjob',
+            name='updated',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def move_errors(apps, schema_editor):
+    BulkOrderJob = apps.get_model('pretix_automated_orders', 'BulkOrderJob')
+    BulkOrderJobError = apps.get_model('pretix_automated_orders', 'BulkOrderJobError')
+    for job in BulkOrderJob.objects.only('pk', 'errors').iterator():
+        BulkOrderJobError.objects.bulk_create(
+            BulkOrderJobError(job_id=job.pk, row=e.get('row'), email=e.get('email'), error=e.get('error') or '')
+            for e in job.errors or []
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_automated_orders', '0004_bulkorderjob_updated'),
+    ]
+
+    operations = [
+        # The relation only gets its name once the old list of the same name is gone.
+        migrations.CreateModel(
+            name='BulkOrderJobError',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('row', models.PositiveIntegerField(null=True)),
+                ('email', models.TextField(null=True)),
+                ('error', models.TextField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pretix_automated_orders.bulkorderjob')),
+            ],
+            options={
+                'ordering': ('job', 'id'),
+            },
+        ),
+        migrations.RunPython(move_errors, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='bulkorderjob',
+            name='errors',
+        ),
+        migrations.AlterField(
+            model_name='bulkorderjoberror',
+            name='job',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='errors', to='pretix_automated_orders.bulkorderjob'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_automated_orders', '0005_bulkorderjoberror'),
+    ]
+
+    operations = [
+        # Rows of earlier runs were post-processed by the run that created them.
+        migrations.AddField(
+            model_name='bulkorderjobrow',
+            name='notified',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterField(
+            model_name='bulkorderjobrow',
+            name='notified',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_automated_orders', '0006_bulkorderjobrow_notified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulkorderjob',
+            name='spread',
+            field=models.DurationField(null=True),
+        ),
+    ]
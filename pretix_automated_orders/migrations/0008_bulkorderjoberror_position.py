@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_automated_orders', '0007_bulkorderjob_spread'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulkorderjoberror',
+            name='position',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='bulkorderjoberror',
+            index=models.Index(fields=['job', 'position'], name='pretix_auto_job_id_75ae94_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_automated_orders', '0008_bulkorderjoberror_position'),
+    ]
+
+    operations = [
+        # Jobs that already started queued their tasks in the same task that started them.
+        migrations.AddField(
+            model_name='bulkorderjob',
+            name='dispatched',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterField(
+            model_name='bulkorderjob',
+            name='dispatched',
+            field=models.BooleanField(default=False),
+        ),
+    ]
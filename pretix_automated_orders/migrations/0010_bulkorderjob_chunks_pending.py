@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_automated_orders', '0009_bulkorderjob_dispatched'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulkorderjob',
+            name='chunks_pending',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
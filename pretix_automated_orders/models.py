@@ -0,0 +1,112 @@
+from django.conf import settings
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+from django_scopes import ScopedManager
+from pretix.base.models import Event, Order
+
+
+class BulkOrderJob(models.Model):
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_FINISHED = "finished"
+    STATUS_FAILED = "failed"
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, _("pending")),
+        (STATUS_RUNNING, _("running")),
+        (STATUS_FINISHED, _("finished")),
+        (STATUS_FAILED, _("failed")),
+    ]
+
+    event = models.ForeignKey(
+        Event, on_delete=models.CASCADE, related_name="automated_order_jobs"
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL
+    )
+    status = models.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING
+    )
+    total = models.PositiveIntegerField(default=0)
+    succeeded = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    # Last time the job reported progress, used to tell a running job from one whose worker died.
+    updated = models.DateTimeField(null=True)
+    # Window the starts of the run's chunks are spread over, if any.
+    spread = models.DurationField(null=True)
+    # Whether the tasks that create the orders were queued, see start_bulk_job.
+    dispatched = models.BooleanField(default=False)
+    # Number of chunks of the run that have not ended yet. Once a chunk fails the job, the others go on.
+    chunks_pending = models.PositiveIntegerField(default=0)
+    timings = models.JSONField(default=dict)
+
+    objects = ScopedManager(organizer="event__organizer")
+
+    class Meta:
+        ordering = ("-created",)
+
+    @property
+    def processed(self):
+        return self.succeeded + self.failed
+
+    @property
+    def percentage(self):
+        if not self.total:
+            return 100 if self.status == self.STATUS_FINISHED else 0
+        return min(100, int(self.processed * 100 / self.total))
+
+    @property
+    def is_done(self):
+        return self.status in (self.STATUS_FINISHED, self.STATUS_FAILED) and not self.chunks_pending
+
+
+class BulkOrderJobRow(models.Model):
+    """
+    Records that the recipient at position ``row`` of a job's recipient list got its
+    order. It is written in the same transaction as the order, so it doubles as the
+    idempotency key that lets an interrupted run resume without creating duplicates.
+    ``notified`` is set once the signals, invoice and mails of the order are sent or
+    queued, so a resumed run can catch up on the ones an interrupted run missed.
+    """
+
+    job = models.ForeignKey(
+        BulkOrderJob, on_delete=models.CASCADE, related_name="rows"
+    )
+    row = models.PositiveIntegerField()
+    order = models.ForeignKey(
+        Order, null=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    notified = models.BooleanField(default=False)
+
+    objects = ScopedManager(organizer="job__event__organizer")
+
+    class Meta:
+        unique_together = (("job", "row"),)
+        ordering = ("job", "row")
+
+
+class BulkOrderJobError(models.Model):
+    """
+    An error of a job: a recipient that did not get an order, or, with ``position``
+    unset, an error that stopped the whole run. ``position`` is the recipient's
+    position in the job like ``BulkOrderJobRow.row``, ``row`` its row in the list as
+    shown to the user. Errors are rows of their own, so reporting one is an INSERT
+    that does not touch the job.
+    """
+
+    job = models.ForeignKey(
+        BulkOrderJob, on_delete=models.CASCADE, related_name="errors"
+    )
+    position = models.PositiveIntegerField(null=True)
+    row = models.PositiveIntegerField(null=True)
+    email = models.TextField(null=True)
+    error = models.TextField()
+
+    objects = ScopedManager(organizer="job__event__organizer")
+
+    class Meta:
+        ordering = ("job", "id")
+        indexes = [models.Index(fields=["job", "position"])]
@@ -0,0 +1,96 @@
+"""
+Dry runs: what a bulk run would create and how long it would probably take, worked
+out without writing anything.
+"""
+from collections import namedtuple
+from datetime import timedelta
+
+from django.utils.timezone import now
+
+from .models import BulkOrderJob
+
+# Number of finished runs of the organizer the duration estimate is based on.
+RECENT_JOBS = 10
+
+RunPlan = namedtuple(
+    "RunPlan",
+    "orders tickets order_mails attendee_mails invoices chunks based_on seconds_per_order "
+    "worker_seconds_per_order duration chunk_seconds start finish",
+)
+
+
+def recent_rates(event, limit=RECENT_JOBS):
+    """
+    Returns the wall-clock and the worker seconds per order of the organizer's last
+    ``limit`` finished runs, and the number of runs they are based on. The wall-clock
+    time runs from the start of a run to its end, so it includes the parallelism of
+    chunked runs. Runs spread over a time window are left out, their duration is set
+    by the window rather than by the speed of the workers. The worker time is the sum
+    of the stages measured with the ``timings`` option and is ``None`` if none of the
+    runs were timed.
+    """
+    jobs = list(
+        BulkOrderJob.objects.filter(
+            event__organizer_id=event.organizer_id,
+            status=BulkOrderJob.STATUS_FINISHED,
+            started__isnull=False,
+            finished__isnull=False,
+            succeeded__gt=0,
+            spread__isnull=True,
+        ).order_by("-finished")[:limit]
+    )
+    if not jobs:
+        return None, None, 0
+    wall = sum((j.finished - j.started).total_seconds() for j in jobs) / sum(j.succeeded for j in jobs)
+    timed = [j for j in jobs if j.timings]
+    worker = None
+    if timed:
+        worker = sum(sum(s["total"] for s in j.timings.values()) for j in timed) / sum(j.succeeded for j in timed)
+    return wall, worker, len(jobs)
+
+
+def _invoices(ctx, orders):
+    # Every order of a run is paid right away through the free payment provider, so the rules of
+    # BulkOrderContext.invoice_wanted and pretix' invoice_qualified come down to the product.
+    if ctx.invoice_generate not in ("True", "paid"):
+        return 0
+    if not ctx.item.default_price or ctx.item.require_approval:
+        return 0
+    if "web" not in ctx.event.settings.invoice_generate_sales_channels:
+        return 0
+    return orders
+
+
+def plan_run(ctx, orders, tickets, chunk_size=None, start_at=None, spread=None):
+    """
+    Returns a ``RunPlan`` for a run of ``orders`` orders with ``tickets`` tickets in
+    total. Validating the recipients and the quota is left to the form, which does
+    the same checks for a dry run as for a real one.
+    """
+    wall, worker, based_on = recent_rates(ctx.event)
+    chunks = -(-orders // chunk_size) if chunk_size else 1
+    duration = chunk_seconds = None
+    if wall is not None:
+        duration = timedelta(seconds=wall * orders)
+        chunk_seconds = (worker if worker is not None else wall) * min(orders, chunk_size or orders)
+        if spread:
+            # The last chunk starts at the end of the window, the run can not be over before it is done.
+            duration = max(duration, spread + timedelta(seconds=chunk_seconds))
+    start = start_at or now()
+    return RunPlan(
+        orders=orders,
+        tickets=tickets,
+        order_mails=orders,
+        # The tickets are addressed to the customer who placed the order, so no separate attendee
+        # mails are sent for them.
+        attendee_mails=0,
+        invoices=_invoices(ctx, orders),
+        chunks=chunks,
+        based_on=based_on,
+        seconds_per_order=wall,
+        worker_seconds_per_order=worker,
+        duration=duration,
+        chunk_seconds=chunk_seconds,
+        start=start,
+        finish=start + duration if duration is not None else None,
+    )
@@ -0,0 +1,196 @@
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import DateTimeField, ExpressionWrapper, F, Q
+from django.utils.timezone import now
+from django.utils.translation import gettext as _
+from pretix.base.models import Organizer
+
+from . import conf
+from .models import BulkOrderJob, BulkOrderJobError, BulkOrderJobRow
+from .timing import merge_summaries
+
+
+class JobProgress:
+    """
+    Collects the outcome of each recipient in memory and writes it to the
+    ``BulkOrderJob`` in batches, so that reporting progress costs one UPDATE per
+    ``flush_every`` orders (or per ``flush_interval`` seconds) instead of one per order.
+    Errors are inserted as ``BulkOrderJobError`` rows without locking the job.
+    Counters are incremented with ``F()`` expressions, which keeps them correct when
+    several chunks of the same job report concurrently.
+    """
+
+    def __init__(self, job_id, flush_every=100, flush_interval=2.0):
+        self.job_id = job_id
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._succeeded = 0
+        self._failed = 0
+        self._errors = []
+        self._last_flush = time.monotonic()
+
+    def acquire(self):
+        """
+        Starts the job if no other job of its event is running and its organizer has
+        fewer than ``conf.MAX_JOBS_PER_ORGANIZER`` jobs running, and returns whether it
+        was started. A job that failed counts as running as long as some of its chunks
+        have not ended, since they go on creating orders. Jobs that have not reported
+        progress for ``conf.JOB_STALE_AFTER`` seconds, counting the end of a spread
+        run's window as progress, are marked as failed and their chunks as ended, so a
+        job whose worker died does not block the event forever. Returns ``False`` as
+        well if the job is not pending anymore, e.g. because an earlier delivery of the
+        same task already started it.
+        """
+        with transaction.atomic():
+            job = BulkOrderJob.objects.select_related("event").get(pk=self.job_id)
+            # Serializes the starts of the organizer's jobs, so that two of them can not both take the
+            # last free slot. The job is read again once the lock is held.
+            Organizer.objects.select_for_update().get(pk=job.event.organizer_id)
+            job.refresh_from_db(fields=["status"])
+            if job.status != BulkOrderJob.STATUS_PENDING:
+                return False
+            running = BulkOrderJob.objects.filter(
+                Q(status=BulkOrderJob.STATUS_RUNNING) | Q(status=BulkOrderJob.STATUS_FAILED, chunks_pending__gt=0),
+                event__organizer_id=job.event.organizer_id,
+            ).annotate(
+                # The chunks of a spread run may be waiting for their start without reporting anything.
+                window_end=ExpressionWrapper(F("started") + F("spread"), output_field=DateTimeField()),
+            )
+            cutoff = now() - timedelta(seconds=conf.JOB_STALE_AFTER)
+            live = running.filter(Q(updated__gte=cutoff) | Q(window_end__gte=cutoff))
+            stale = list(running.exclude(pk__in=live.values("pk")).values_list("pk", "status"))
+            for pk, status in stale:
+                if status == BulkOrderJob.STATUS_RUNNING:
+                    JobProgress(pk).abort(_("The run stopped reporting progress, e.g. because its worker died."))
+            BulkOrderJob.objects.filter(pk__in=[pk for pk, status in stale]).update(chunks_pending=0)
+            running = live
+            if running.filter(event_id=job.event_id).exists():
+                return False
+            if conf.MAX_JOBS_PER_ORGANIZER and running.count() >= conf.MAX_JOBS_PER_ORGANIZER:
+                return False
+            self.start()
+        return True
+
+    def start(self):
+        if self.job_id is None:
+            return
+        BulkOrderJob.objects.filter(
+            pk=self.job_id, status=BulkOrderJob.STATUS_PENDING
+        ).update(status=BulkOrderJob.STATUS_RUNNING, started=now(), updated=now())
+
+    def start_chunks(self, count):
+        """
+        Records that the run was split into ``count`` chunks, which keep the job
+        running until each of them called ``chunk_done``.
+        """
+        if self.job_id is None:
+            return
+        BulkOrderJob.objects.filter(pk=self.job_id).update(chunks_pending=count)
+
+    def chunk_done(self):
+        if self.job_id is None:
+            return
+        BulkOrderJob.objects.filter(pk=self.job_id, chunks_pending__gt=0).update(
+            chunks_pending=F("chunks_pending") - 1
+        )
+
+    def completed_rows(self, start, count):
+        """
+        Returns the positions between ``start`` and ``start + count`` in the job's
+        recipient list that already got their order, with a single query.
+        """
+        if self.job_id is None:
+            return set()
+        return set(
+            BulkOrderJobRow.objects.filter(
+                job_id=self.job_id, row__gte=start, row__lt=start + count
+            ).values_list("row", flat=True)
+        )
+
+    def unnotified_rows(self, start, count):
+        """
+        Returns the positions between ``start`` and ``start + count`` that got their
+        order but are not marked as notified, mapped to the id of the order.
+        """
+        if self.job_id is None:
+            return {}
+        return dict(
+            BulkOrderJobRow.objects.filter(
+                job_id=self.job_id, row__gte=start, row__lt=start + count, notified=False, order__isnull=False
+            ).values_list("row", "order_id")
+        )
+
+    def notified(self, rows):
+        """
+        Marks the positions ``rows`` as notified, see ``BulkOrderJobRow``.
+        """
+        if self.job_id is None or not rows:
+            return
+        BulkOrderJobRow.objects.filter(job_id=self.job_id, row__in=rows).update(notified=True)
+
+    def success(self):
+        self._succeeded += 1
+        self._maybe_flush()
+
+    def failure(self, position, row, email, message):
+        self._failed += 1
+        self._errors.append({"position": position, "row": row, "email": email, "error": str(message)})
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        pending = self._succeeded + self._failed
+        if pending >= self.flush_every or (
+            time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if self.job_id is None or not (self._succeeded or self._failed or self._errors):
+            return
+        with transaction.atomic():
+            if self._errors:
+                BulkOrderJobError.objects.bulk_create(
+                    BulkOrderJobError(job_id=self.job_id, **e) for e in self._errors
+                )
+            BulkOrderJob.objects.filter(pk=self.job_id).update(
+                succeeded=F("succeeded") + self._succeeded,
+                failed=F("failed") + self._failed,
+                updated=now(),
+            )
+        self._succeeded = 0
+        self._failed = 0
+        self._errors = []
+
+    def add_timings(self, timer):
+        """
+        Adds the stage times of a ``StageTimer`` to the ones stored on the job.
+        """
+        if self.job_id is None or not timer.enabled:
+            return
+        with transaction.atomic():
+            job = BulkOrderJob.objects.select_for_update().get(pk=self.job_id)
+            job.timings = merge_summaries(job.timings, timer.summary())
+            job.save(update_fields=["timings"])
+
+    def abort(self, error):
+        """
+        Marks the job as failed because of an error that affects the whole run.
+        """
+        messages = getattr(error, "messages", None) or [str(error)]
+        self._errors.extend({"row": None, "email": None, "error": str(m)} for m in messages)
+        self.finish(BulkOrderJob.STATUS_FAILED)
+
+    def finish(self, status=BulkOrderJob.STATUS_FINISHED):
+        self.flush()
+        if self.job_id is None:
+            return
+        # Recipients skipped on a resumed run were counted by the earlier attempt, or not at all if it
+        # died before flushing, so the final number is taken from the rows instead of the counter.
+        BulkOrderJob.objects.filter(pk=self.job_id).update(
+            status=status,
+            finished=now(),
+            succeeded=BulkOrderJobRow.objects.filter(job_id=self.job_id).count(),
+        )
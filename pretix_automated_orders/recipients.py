@@ -0,0 +1,388 @@
+import codecs
+import csv
+import io
+import re
+from collections import namedtuple
+from datetime import timedelta
+from itertools import islice
+from operator import itemgetter
+
+from django.core.exceptions import ValidationError
+from django.core.validators import EmailValidator
+from django.utils.timezone import now
+from django.utils.translation import gettext_lazy as _
+from pretix.base.models import CachedFile
+
+Recipient = namedtuple("Recipient", "email number name tag row locale")
+
+CSV_FIELDS = ("email", "name", "tag", "number", "locale")
+
+_email_validator = EmailValidator()
+_email_user_regex = re.compile(EmailValidator.user_regex.pattern, EmailValidator.user_regex.flags)
+_email_domain_regex = re.compile(EmailValidator.domain_regex.pattern, EmailValidator.domain_regex.flags)
+
+
+def _is_valid_email(value):
+    # Django's EmailValidator resolves its lazily compiled regexes on every call. The common case is
+    # checked against precompiled copies, anything they do not accept (IP literals, IDN domains or invalid
+    # addresses) still goes through the validator itself, so the result is the same.
+    if value and len(value) <= 320 and "@" in value:
+        user_part, domain_part = value.rsplit("@", 1)
+        if _email_user_regex.match(user_part) and (
+            domain_part in _email_validator.domain_allowlist or _email_domain_regex.match(domain_part)
+        ):
+            return True
+    try:
+        _email_validator(value)
+    except ValidationError:
+        return False
+    return True
+
+
+def _check_fields(fieldnames):
+    unknown_fields = [f for f in fieldnames if f not in CSV_FIELDS]
+    if unknown_fields:
+        raise ValidationError(
+            _(
+                'CSV input contains an unknown field with the header "{header}".'
+            ).format(header=unknown_fields[0])
+        )
+
+
+class RecipientValidator:
+    """
+    Validates a recipient list in a single pass and collects every problem together
+    with its row number instead of stopping at the first one. The email regexes are
+    compiled once and duplicates are detected with a set of the addresses seen so far.
+    If given, ``existing_emails`` is called with the addresses of every
+    ``lookup_batch_size`` valid rows and returns the lowercased ones that already have
+    an order, which are reported as well. If ``locales`` is given, the optional locale
+    column needs to contain one of them, in any case, and is changed to the event's
+    spelling. With ``allow_unknown_locales``, other locales are kept as they are.
+
+    Problems with the list as a whole, like a missing header, are raised right away.
+    ``position`` is the number of UTF-8 bytes read from the stream so far. Without
+    ``existing_emails``, every valid row is yielded as soon as it is read, so it is
+    where the row after the last one yielded starts.
+    """
+
+    max_reported_errors = 20
+    lookup_batch_size = 1000
+
+    def __init__(self, existing_emails=None, allow_duplicates=False, locales=None, allow_unknown_locales=False):
+        self.existing_emails = existing_emails
+        self.allow_duplicates = allow_duplicates
+        self.locales = {locale.lower(): locale for locale in locales} if locales is not None else None
+        self.allow_unknown_locales = allow_unknown_locales
+        self.errors = []
+        self.rows = 0
+        self.tickets = 0
+        self.position = 0
+        self._seen = {}
+
+    def iter(self, stream, offset=None, row=0):
+        """
+        Lazily parses a recipient list from a seekable text stream and yields the valid
+        rows. Only the first kilobyte is read up front to tell CSV input from a plain
+        list of email addresses and to sniff the CSV dialect, so the list never has
+        to fit into memory.
+
+        With ``offset``, the rows are read from that byte offset of the stream on, after
+        the header, and numbered as if the row before had the number ``row``.
+        """
+        return self._iter_checked(self._iter_rows(stream, offset, row))
+
+    def iter_records(self, records):
+        """
+        Like ``iter``, for recipients that are already split into their fields: dicts
+        with the keys of the CSV columns, e.g. from a JSON request.
+        """
+        return self._iter_checked(self._iter_records(records))
+
+    def _iter_checked(self, rows):
+        batch = []
+        for row, email, name, number, tag, locale in rows:
+            recipient = self._check(row, email, name, number, tag, locale)
+            if recipient is not None:
+                batch.append(recipient)
+                if len(batch) >= self.lookup_batch_size or self.existing_emails is None:
+                    yield from self._accept(batch)
+                    batch = []
+        yield from self._accept(batch)
+
+    def _accept(self, recipients):
+        if self.existing_emails is not None and recipients:
+            existing = self.existing_emails([r.email for r in recipients])
+            if existing:
+                for recipient in recipients:
+                    if recipient.email.lower() in existing:
+                        self.errors.append((recipient.row, _("{value} already has an order for this event.").format(
+                            value=recipient.email
+                        )))
+                recipients = [r for r in recipients if r.email.lower() not in existing]
+        self.rows += len(recipients)
+        self.tickets += sum(r.number for r in recipients)
+        return recipients
+
+    def _lines(self, stream):
+        for line in stream:
+            self.position += len(line.encode("utf-8"))
+            yield line
+
+    def _seek(self, stream, offset):
+        if offset is not None:
+            stream.seek(offset)
+            self.position = offset
+
+    def _iter_rows(self, stream, offset=None, row=0):
+        head = stream.read(1024)
+        stream.seek(0)
+        lines = self._lines(stream)
+        if "," in head or ";" in head:
+            if "@" in head.split("\n")[0]:
+                raise ValidationError(
+                    _("CSV input needs to contain a header row in the first line.")
+                )
+            try:
+                dialect = csv.Sniffer().sniff(head)
+                reader = csv.reader(lines, dialect=dialect)
+                fieldnames = next(reader, [])
+            except csv.Error as e:
+                raise ValidationError(
+                    _("CSV parsing failed: {error}.").format(error=str(e))
+                )
+            if "email" not in fieldnames:
+                raise ValidationError(
+                    _(
+                        'CSV input needs to contain a field with the header "{header}".'
+                    ).format(header="email")
+                )
+            _check_fields(fieldnames)
+            # Plain rows with column indices are a lot cheaper than a DictReader on long lists. Missing columns
+            # point to the None appended to every row.
+            width = len(fieldnames)
+            columns = itemgetter(*(
+                fieldnames.index(f) if f in fieldnames else width for f in ("email", "name", "number", "tag", "locale")
+            ))
+            self._seek(stream, offset)
+            for i, values in enumerate(reader, row):
+                if not values:
+                    continue
+                values += [None] * (width + 1 - len(values))
+                yield (i + 1,) + columns(values)
+        else:
+            self._seek(stream, offset)
+            for i, line in enumerate(lines, row):
+                if line.strip():
+                    yield i + 1, line, None, None, None, None
+
+    def _iter_records(self, records):
+        for i, record in enumerate(records):
+            _check_fields(record)
+            # Like the columns of a CSV file, every field is text.
+            yield (i + 1,) + tuple(
+                None if record.get(f) is None else str(record[f]) for f in ("email", "name", "number", "tag", "locale")
+            )
+
+    def _check(self, row, email, name, number, tag, locale):
+        email = (email or "").strip()
+        if not _is_valid_email(email):
+            self.errors.append(
+                (row, _("{value} is not a valid email address.").format(value=email))
+            )
+            return None
+        if number:
+            try:
+                number = int(number)
+                if number < 1:
+                    raise ValueError(number)
+            except ValueError:
+                self.errors.append((row, _("{value} is not a valid number of tickets.").format(value=number)))
+                return None
+        else:
+            number = 1
+        locale = (locale or "").strip() or None
+        if locale and self.locales is not None:
+            if locale.lower() in self.locales:
+                locale = self.locales[locale.lower()]
+            elif not self.allow_unknown_locales:
+                self.errors.append((row, _("{value} is not a language of this event.").format(value=locale)))
+                return None
+        if not self.allow_duplicates:
+            key = email.lower()
+            if key in self._seen:
+                self.errors.append((row, _("{value} is already listed in row {row}.").format(
+                    value=email, row=self._seen[key]
+                )))
+                return None
+            self._seen[key] = row
+        return Recipient(email, number, name or "", tag, row, locale)
+
+    def raise_errors(self):
+        """
+        Raises a ``ValidationError`` listing the first errors and the total number of
+        invalid rows, if there were any.
+        """
+        if not self.errors:
+            return
+        # Rows whose address already has an order are only found once their batch is looked up, after
+        # problems in later rows.
+        self.errors.sort(key=lambda e: e[0])
+        messages = [
+            _("Row {row}: {error}").format(row=row, error=error)
+            for row, error in self.errors[:self.max_reported_errors]
+        ]
+        if len(self.errors) > self.max_reported_errors:
+            messages.append(_("{count} more rows contain errors.").format(
+                count=len(self.errors) - self.max_reported_errors
+            ))
+        raise ValidationError(messages)
+
+
+def iter_recipients(stream, locales=None, offset=None, row=0):
+    """
+    Yields the recipients of an already validated list, e.g. a stored upload that is
+    read again by a worker, optionally from the byte ``offset`` on, see
+    ``RecipientValidator.iter``. Their locales are changed to the spelling of
+    ``locales`` like the form does. A locale the event no longer has is kept, so the
+    recipient keeps its position in the run and its order fails instead of being left
+    out.
+    """
+    validator = RecipientValidator(allow_duplicates=True, locales=locales, allow_unknown_locales=True)
+    return validator.iter(stream, offset, row)
+
+
+def recipient_dicts(recipients, separate_orders=False):
+    """
+    Converts ``Recipient`` tuples into the dicts the tasks work on, so the task
+    arguments do not depend on the field order of the tuple. With
+    ``separate_orders``, a recipient with a ``number`` larger than one becomes that
+    many single-ticket orders instead of one order with that many tickets.
+    """
+    for r in recipients:
+        d = r._asdict()
+        if separate_orders and r.number > 1:
+            for i in range(r.number):
+                yield dict(d, number=1)
+        else:
+            yield d
+
+
+def open_recipient_file(f):
+    return io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+
+
+def store_recipient_file(upload, count, tickets, separate_orders=False, keep_until=None):
+    """
+    Stores an uploaded recipient list in pretix' file storage and returns the
+    reference that is handed to the tasks in place of the recipient list, together
+    with the ``count`` of orders and the number of ``tickets`` the form found in it.
+    The file is kept for a week, or a week after ``keep_until`` for runs scheduled
+    later.
+    """
+    cf = CachedFile.objects.create(
+        expires=max(now(), keep_until or now()) + timedelta(days=7),
+        date=now(),
+        filename=upload.name,
+        type="text/csv",
+        web_download=False,
+    )
+    upload.seek(0)
+    cf.file.save(upload.name, upload)
+    return {"file": str(cf.pk), "count": count, "tickets": tickets, "separate_orders": separate_orders}
+
+
+def load_recipients(recipients, locales=None):
+    """
+    Iterates the recipients a task was given: either the list of recipient dicts
+    itself or a file reference created by ``store_recipient_file``, optionally
+    narrowed down to the positions ``start`` to ``stop``. A slice made by
+    ``split_recipients`` starts reading the file at its ``offset`` instead of the
+    beginning. ``locales`` are the languages of the event, see ``iter_recipients``.
+    """
+    if isinstance(recipients, list):
+        yield from recipients
+        return
+    cf = CachedFile.objects.get(pk=recipients["file"])
+    with cf.file.open("rb") as f:
+        stream = open_recipient_file(f)
+        rows = recipient_dicts(
+            iter_recipients(stream, locales, recipients.get("offset"), recipients.get("offset_row", 0)),
+            recipients.get("separate_orders", False),
+        )
+        # The position of the first recipient after the offset.
+        first = recipients.get("offset_start", 0)
+        stop = recipients.get("stop")
+        yield from islice(rows, recipients.get("start", 0) - first, None if stop is None else stop - first)
+
+
+def _file_positions(f, separate_orders):
+    """
+    Yields the position in the run and the number of orders of every recipient of a
+    stored file, together with the byte offset and number of the row before it.
+    """
+    bom = len(codecs.BOM_UTF8) if f.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8 else 0
+    f.seek(0)
+    stream = open_recipient_file(f)
+    # The validator counts the bytes of the decoded text, which lacks the byte order mark.
+    validator = RecipientValidator(allow_duplicates=True, allow_unknown_locales=True)
+    position, offset, row = 0, None, 0
+    for r in validator.iter(stream):
+        orders = r.number if separate_orders else 1
+        yield position, orders, offset, row
+        position += orders
+        offset, row = bom + validator.position, r.row
+
+
+def split_recipients(recipients, size):
+    """
+    Splits the recipients a task was given into slices of ``size`` positions. The
+    slices of a file get the byte offset of the row their first recipient is in,
+    which is found in a single pass over the file, so that every chunk of a run
+    reads its own rows instead of every row before them as well.
+    """
+    count = count_recipients(recipients)
+    slices = [slice_recipients(recipients, i, i + size) for i in range(0, count, size)]
+    if isinstance(recipients, list) or not slices:
+        return slices
+    cf = CachedFile.objects.get(pk=recipients["file"])
+    with cf.file.open("rb") as f:
+        pending = iter(slices)
+        current = next(pending)
+        for position, orders, offset, row in _file_positions(f, recipients.get("separate_orders", False)):
+            while current is not None and current["start"] < position + orders:
+                if offset is not None:
+                    current.update(offset=offset, offset_row=row, offset_start=position)
+                current = next(pending, None)
+            if current is None:
+                break
+    return slices
+
+
+def slice_recipients(recipients, start, stop=None):
+    if isinstance(recipients, list):
+        return recipients[start:stop]
+    offset = recipients.get("start", 0)
+    end = recipients.get("stop")
+    if stop is not None:
+        end = offset + stop if end is None else min(end, offset + stop)
+    return dict(recipients, start=offset + start, stop=end)
+
+
+def count_tickets(recipients, skip=()):
+    """
+    Returns the number of tickets of the recipients a task was given, leaving out the
+    positions in ``skip``. A stored file knows its number of tickets from the form,
+    so it is only read again to leave some out, e.g. on a resumed run.
+    """
+    if isinstance(recipients, dict) and "tickets" in recipients and "start" not in recipients and not skip:
+        return recipients["tickets"]
+    return sum(c.get("number", 1) for i, c in enumerate(load_recipients(recipients)) if i not in skip)
+
+
+def count_recipients(recipients):
+    if isinstance(recipients, list):
+        return len(recipients)
+    stop = recipients.get("stop")
+    count = recipients["count"] if stop is None else min(stop, recipients["count"])
+    return max(0, count - recipients.get("start", 0))
@@ -1,12 +1,30 @@
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from django.urls import resolve, reverse
+from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
+from pretix.base.models import Item
+from pretix.base.signals import EventPluginSignal, logentry_display
 from pretix.control.signals import nav_event
 
+from .forms import invalidate_eligible_items
+
+bulk_orders_placed = EventPluginSignal()
+"""
+Arguments: ``orders``
+
+Sent after a batch of orders created by an automated bulk run with deferred signals
+has been committed, from a task on the ``signal_queue``. ``orders`` is a list of the
+orders of the batch. ``order_placed`` and ``order_paid`` are still sent for every
+single order of the batch right before, so only listen to this signal if you want
+to handle the orders of a bulk run together.
+
+As with all event-plugin signals, the ``sender`` keyword argument will contain the event.
+"""
+
 
 @receiver(nav_event, dispatch_uid="automated_orders_nav")
 def navbar_info(sender, request, **kwargs):
-    url = resolve(request.path_info)
+    url = request.resolver_match
     if request.user.has_event_permission(
         request.organizer, request.event, "can_view_orders"
     ) or request.user.has_active_staff_session(request.session.session_key):
@@ -21,8 +39,24 @@ def navbar_info(sender, request, **kwargs):
                         "organizer": request.organizer.slug,
                     },
                 ),
-                "active": url.namespace == "plugins:pretix_automated_orders"
+                "active": url is not None
+                and url.namespace == "plugins:pretix_automated_orders"
                 and url.url_name == "index",
             }
         ]
     return []
+
+
+@receiver(post_save, sender=Item, dispatch_uid="automated_orders_item_saved")
+@receiver(post_delete, sender=Item, dispatch_uid="automated_orders_item_deleted")
+def item_changed(sender, instance, **kwargs):
+    invalidate_eligible_items(instance.event_id)
+
+
+@receiver(signal=logentry_display, dispatch_uid="automated_orders_logentry_display")
+def automated_orders_logentry_display(sender, logentry, **kwargs):
+    if logentry.action_type == "pretix_automated_orders.bulk.finished":
+        data = logentry.parsed_data
+        return _(
+            "Automated orders were created: {created} succeeded, {failed} failed."
+        ).format(created=data.get("created", 0), failed=data.get("failed", 0))
@@ -0,0 +1,24 @@
+/*globals $*/
+$(function () {
+    "use strict";
+
+    function poll($job) {
+        $.getJSON($job.attr("data-status-url"), function (data) {
+            var $bar = $job.find(".progress-bar");
+            $bar.css("width", data.percentage + "%").text(data.percentage + "%");
+            $bar.toggleClass("progress-bar-warning", data.failed > 0);
+            $job.find(".automated-orders-job-status").text(data.status);
+            $job.find(".automated-orders-job-succeeded").text(data.succeeded);
+            $job.find(".automated-orders-job-failed").text(data.failed);
+            if (data.done) {
+                $bar.removeClass("progress-bar-striped active");
+            } else {
+                window.setTimeout(function () { poll($job); }, 2000);
+            }
+        });
+    }
+
+    $(".automated-orders-job[data-done=false]").each(function () {
+        poll($(this));
+    });
+});
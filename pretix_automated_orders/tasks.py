@@ -1,21 +1,32 @@
+import json
+import logging
+import math
+import time
+from collections import defaultdict
+from itertools import groupby
+from datetime import timedelta
 from decimal import Decimal
 
+from celery import chord
+from celery.exceptions import Retry
+from celery.utils.time import rate
+
 from django.conf import settings
 from django.contrib import messages
-from django.db import transaction
-from django.db.models import Prefetch, prefetch_related_objects
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, connections, transaction
 from django.shortcuts import reverse, redirect
 from django.utils.timezone import now
 from django.utils.translation import gettext as _
 from django.views.generic.edit import FormView
-from django_scopes import scope
-from pretix.api.serializers.order import OrderCreateSerializer, OrderSerializer
+from django_scopes import scope, scopes_disabled
+from pretix.api.serializers.order import OrderCreateSerializer
 from pretix.base.i18n import language
-from pretix.base.models import Checkin, Order, OrderPosition
+from pretix.base.models import LogEntry, Order
 from pretix.base.models.auth import User
 from pretix.base.models.event import Event
-from pretix.base.models.orders import QuestionAnswer
-from pretix.base.services.invoices import generate_invoice, invoice_qualified
+from pretix.base.services.invoices import generate_invoice, invoice_pdf_task, invoice_qualified
 from pretix.base.services.orders import (
     _order_placed_email,
     _order_placed_email_attendee,
@@ -25,190 +36,727 @@ from pretix.base.views.tasks import AsyncAction
 from pretix.celery_app import app
 from django.contrib.auth import get_user_model
 from pretix.control.permissions import EventPermissionRequiredMixin
+from . import conf
+from .context import BulkOrderContext
+from .fastpath import FastPathUnavailable, OrderPrototype, create_orders
 from .forms import AutomatedBulkOrdersForm
+from .models import BulkOrderJob, BulkOrderJobRow
+from .progress import JobProgress
+from .recipients import count_recipients, count_tickets, load_recipients, slice_recipients, split_recipients
+from .signals import bulk_orders_placed
 from pretix.base.models.organizer import Organizer
+from rest_framework.exceptions import ValidationError
+
+logger = logging.getLogger(__name__)
+
+
+def _order_data(ctx, customer):
+    customer_name = customer.get("name") or "blank"
+    customer_email = customer["email"]
+    return {
+        "email": customer_email,
+        "locale": customer.get("locale") or ctx.locale,
+        "sales_channel": "web",
+        "positions": [
+            {
+                "item": ctx.item.pk,
+                "attendee_name": customer_name,
+                "attendee_email": customer_email,
+            }
+            for i in range(customer.get("number", 1))
+        ],
+        "payment_provider": "free",
+        "send_email": True,
+    }
+
+
+def _log_order(ctx, order, provider, log_entries):
+    log_entries.append(order.log_action(
+        "pretix.event.order.placed",
+        user=ctx.user,
+        auth=None,
+        save=False,
+    ))
+    if order.status == Order.STATUS_PAID:
+        log_entries.append(order.log_action(
+            "pretix.event.order.paid",
+            {
+                "provider": provider,
+                "info": {},
+                "date": now().isoformat(),
+                "force": False,
+            },
+            user=ctx.user,
+            auth=None,
+            save=False,
+        ))
+
+
+def _place_order(ctx, customer, log_entries, job_id=None, key=None):
+    """
+    Creates the order for one recipient. If the run belongs to a job, the recipient's
+    position ``key`` in the job is recorded in the same transaction. Returns the order
+    and whether its notification mail should be sent, or ``(None, False)`` if another
+    attempt already created it.
+
+    The log entries of the order are not saved but appended to ``log_entries``, see
+    ``_place_batch``.
+    """
+    data = _order_data(ctx, customer)
+    serializer = OrderCreateSerializer(context={"event": ctx.event})
+    with ctx.timer.stage("validate"):
+        validated_data = ctx.order_data(data)
+    try:
+        with ctx.timer.stage("create"), transaction.atomic():
+            order = serializer.create(validated_data)
+            send_mail = serializer._send_mail
+            if job_id is not None:
+                BulkOrderJobRow.objects.create(job_id=job_id, row=key, order=order)
+    except IntegrityError:
+        if job_id is not None and BulkOrderJobRow.objects.filter(job_id=job_id, row=key).exists():
+            return None, False
+        raise
+    _log_order(ctx, order, data["payment_provider"], log_entries)
+    return order, send_mail
+
+
+def _place_fast(ctx, prototype, batch, log_entries, job_id=None):
+    """
+    Creates the orders for a list of ``(key, customer)`` pairs by copying
+    ``prototype`` in a single savepoint. Returns the results like ``_place_batch``,
+    or ``None`` if the fast path can not be used for them.
+    """
+    items = [(key, _order_data(ctx, customer)) for key, customer in batch]
+    try:
+        with ctx.timer.stage("create"), transaction.atomic():
+            orders = create_orders(ctx, prototype, items, job_id)
+    except (FastPathUnavailable, IntegrityError):
+        # Lacking quota or recipients that already got their order in another attempt: the regular path
+        # handles them one by one.
+        return None
+    for order, (key, data) in zip(orders, items):
+        _log_order(ctx, order, data["payment_provider"], log_entries)
+    return [
+        (key, customer, order, prototype.send_mail, None)
+        for (key, customer), order in zip(batch, orders)
+    ]
+
+
+def _save_log_entries(log_entries):
+    if connections["default"].features.can_return_rows_from_bulk_insert:
+        LogEntry.objects.bulk_create(log_entries)
+    else:
+        for le in log_entries:
+            le.save()
+
+
+def _batches(recipients, done=(), start=0):
+    """
+    Groups the recipients into lists of ``(key, customer)`` pairs of up to
+    ``conf.ORDER_BATCH_SIZE`` entries, leaving out the keys in ``done``.
+    """
+    batch = []
+    for i, customer in enumerate(recipients, start):
+        if i in done:
+            continue
+        batch.append((i, customer))
+        if len(batch) >= conf.ORDER_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _place_order_result(ctx, key, customer, log_entries, job_id, catch):
+    try:
+        order, send_mail = _place_order(ctx, customer, log_entries, job_id, key)
+    except catch as e:
+        logger.error("Could not create automated order for %s", customer["email"], exc_info=e)
+        return key, customer, None, False, e
+    return key, customer, order, send_mail, None
+
+
+def _place_batch(ctx, batch, job_id=None, catch=Exception, fast=False):
+    """
+    Creates the orders for a batch of ``(key, customer)`` pairs in a single
+    transaction, so the commit is paid once per batch instead of once per order.
+    Every order gets its own savepoint: if creating it raises one of the ``catch``
+    exceptions, only that order is rolled back and the error is returned in its
+    result. Any other exception rolls back the whole batch.
+
+    With ``fast``, the first order of each number of tickets is placed as usual and
+    all further ones are copied from it in bulk, see fastpath.py.
+
+    The log entries of all orders are inserted together at the end of the batch.
+    Returns a list of ``(key, customer, order, send_mail, error)`` tuples.
+    """
+    results = []
+    log_entries = []
+    copies = defaultdict(list)
+    with transaction.atomic():
+        for key, customer in batch:
+            number = customer.get("number", 1)
+            if ctx.prototypes.get(number) is not None:
+                copies[number].append((key, customer))
+                continue
+            result = _place_order_result(ctx, key, customer, log_entries, job_id, catch)
+            results.append(result)
+            order, send_mail = result[2:4]
+            if fast and order is not None and number not in ctx.prototypes:
+                try:
+                    ctx.prototypes[number] = OrderPrototype(order, send_mail)
+                except FastPathUnavailable:
+                    ctx.prototypes[number] = None
+
+        for number, pairs in copies.items():
+            fast_results = _place_fast(ctx, ctx.prototypes[number], pairs, log_entries, job_id)
+            if fast_results is None:
+                fast_results = [
+                    _place_order_result(ctx, key, customer, log_entries, job_id, catch) for key, customer in pairs
+                ]
+            results += fast_results
+        start = ctx.timer.clock()
+        _save_log_entries(log_entries)
+    ctx.timer.record("commit", start)
+    LogEntry.bulk_postprocess(log_entries)
+    return results
+
+
+def _locale_groups(ctx, results):
+    """
+    Groups the results of ``_place_batch`` by the locale of their order, so the
+    language is activated once per locale instead of once per order.
+    """
+    def locale(result):
+        return result[2].locale if result[2] is not None else ctx.locale
+    return groupby(sorted(results, key=locale), key=locale)
+
+
+def _order_placed(ctx, order, send_mail, mails=None, pdfs=None, signals=None):
+    """
+    Everything that happens after an order is committed: signals, the invoice and the
+    notification mails. With ``mails``, ``pdfs`` or ``signals``, the mails, invoice
+    PDFs respectively signals are collected and handled in batches instead of right
+    away. Expects the order's language to be active, see ``_locale_groups``.
+    """
+    event = ctx.event
+    payment = order.payments.last()
+    with ctx.timer.stage("signals"):
+        if signals is not None:
+            signals.add(order.pk)
+        else:
+            order_placed.send(event, order=order)
+            if order.status == Order.STATUS_PAID:
+                order_paid.send(event, order=order)
+
+    gen_invoice = (
+            ctx.invoice_wanted(order)
+            and invoice_qualified(order)
+            and not order.invoices.last()
+    )
+    invoice = None
+    if gen_invoice:
+        # Like pretix itself, leave the PDF to the mail task if the invoice is attached to the mail anyway,
+        # it renders missing invoice files before sending.
+        mail_renders_pdf = send_mail and ctx.invoice_email_attachment and order.email
+        with ctx.timer.stage("invoice"):
+            invoice = generate_invoice(order, trigger_pdf=pdfs is None and not mail_renders_pdf)
+        if pdfs is not None and not mail_renders_pdf:
+            pdfs.add(invoice.pk)
+
+    if send_mail:
+        with ctx.timer.stage("mail"):
+            if mails is not None:
+                mails.add(order.pk)
+            else:
+                _send_order_mails(ctx, order, payment, invoice)
+
+
+def _notified(progress, keys, mails, signals):
+    """
+    Queues the mails and signals collected so far and then marks the rows ``keys``
+    as notified, so a row is only marked once nothing of its post-processing is left
+    in memory. Deferred invoice PDFs are the exception, pretix renders a missing PDF
+    anyway once the invoice is downloaded or attached to a mail.
+    """
+    if mails:
+        mails.flush()
+    if signals:
+        signals.flush()
+    progress.notified(keys)
+
+
+def _catch_up(ctx, progress, start, count, mails, pdfs, signals):
+    """
+    Redoes the post-processing of the orders an earlier attempt committed but did not
+    mark as notified, e.g. because its worker died in between. Whatever the earlier
+    attempt got to before it died, like some of the mails, is sent again.
+    """
+    rows = {order_id: key for key, order_id in progress.unnotified_rows(start, count).items()}
+    if not rows:
+        return
+    results = [(rows[order.pk], None, order, True, None) for order in ctx.event.orders.filter(pk__in=rows)]
+    keys = []
+    for locale, group in _locale_groups(ctx, results):
+        with language(locale, ctx.region):
+            for key, customer, order, send_mail, error in group:
+                try:
+                    _order_placed(ctx, order, send_mail, mails, pdfs, signals)
+                except Exception:
+                    logger.exception("Post-processing of automated order %s failed", order.code)
+                    continue
+                keys.append(key)
+    _notified(progress, keys, mails, signals)
+
+
+def _send_order_mails(ctx, order, payment, invoice, pace=None):
+    event = ctx.event
+    pace = pace or MailPacer(None)
+    free_flow = (
+            payment
+            and order.total == Decimal("0.00")
+            and order.status == Order.STATUS_PAID
+            and not order.require_approval
+            and payment.provider in ("free", "boxoffice")
+    )
+    if order.require_approval:
+        templates = ctx.mails_require_approval
+    elif free_flow:
+        templates = ctx.mails_free
+    else:
+        templates = ctx.mails_placed
+
+    pace()
+    _order_placed_email(
+        event,
+        order,
+        templates.text,
+        templates.subject,
+        templates.log_entry,
+        invoice,
+        [payment] if payment else [],
+        is_free=free_flow,
+    )
+    if templates.attendees:
+        for p in order.positions.all():
+            if (
+                    p.addon_to_id is None
+                    and p.attendee_email
+                    and p.attendee_email != order.email
+            ):
+                pace()
+                _order_placed_email_attendee(
+                    event,
+                    order,
+                    p,
+                    templates.attendee_text,
+                    templates.attendee_subject,
+                    templates.log_entry,
+                    is_free=free_flow,
+                )
+
+    if not free_flow and order.status == Order.STATUS_PAID and payment:
+        pace()
+        payment._send_paid_mail(invoice, None, "")
+        if ctx.mail_send_order_paid_attendee:
+            for p in order.positions.all():
+                if (
+                        p.addon_to_id is None
+                        and p.attendee_email
+                        and p.attendee_email != order.email
+                ):
+                    pace()
+                    payment._send_paid_mail_attendee(p, None)
+
+
+def _save_timings(ctx, progress):
+    if not ctx.timer.enabled:
+        return
+    progress.add_timings(ctx.timer)
+    if conf.METRICS:
+        ctx.timer.export_metrics()
+
+
+def _log_timings(job_id, timings):
+    if timings:
+        logger.info(json.dumps({"job": job_id, "timings": timings}, sort_keys=True))
+
+
+class MailBatch:
+    """
+    Buffers the orders whose notifications should be sent and hands them to
+    ``send_order_mails`` in batches of ``conf.MAIL_BATCH_SIZE`` on the mail queue,
+    so the order loop never waits on the mail server.
+    """
+
+    def __init__(self, event):
+        self.event = event
+        self._order_ids = []
+
+    def add(self, order_id):
+        self._order_ids.append(order_id)
+        if len(self._order_ids) >= conf.MAIL_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._order_ids:
+            send_order_mails.apply_async(
+                args=(self.event.pk, self.event.organizer_id, self._order_ids),
+                queue=conf.MAIL_QUEUE,
+            )
+            self._order_ids = []
+
+
+class MailPacer:
+    """
+    Spaces out the mails of all mail tasks so that together they hand at most
+    ``rate_limit`` mails (a Celery rate such as "10/s" or "100/m") to pretix' mail
+    queue. Time is divided into slots of one mail each, which are taken in pretix'
+    cache, shared by all workers if it is Redis. Called before each mail, it takes
+    the next free slot and waits for it. With a cache that can not be shared, e.g.
+    pretix' default dummy cache, each task only spaces out its own mails. Without a
+    rate limit it never waits.
+    """
+
+    def __init__(self, rate_limit):
+        self.interval = 1 / rate(rate_limit) if rate_limit else 0
+        self._next = time.time()
+
+    def __call__(self):
+        if not self.interval:
+            return
+        slot = math.ceil(max(time.time(), self._next) / self.interval)
+        # The tasks wait for their slot after taking it, so each one holds at most one slot ahead and a free
+        # slot is found after as many tries as there are tasks sending mails.
+        while not cache.add(
+            "automated_orders:mail_slot:{}".format(slot), True,
+            timeout=math.ceil((slot + 1) * self.interval - time.time()) + 1,
+        ):
+            slot += 1
+        self._next = (slot + 1) * self.interval
+        delay = slot * self.interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SignalBatch:
+    """
+    Buffers the orders whose ``order_placed`` and ``order_paid`` signals should be sent
+    and hands them to ``send_order_signals`` in batches of ``conf.ORDER_BATCH_SIZE`` on
+    ``conf.SIGNAL_QUEUE``, so slow receivers do not hold up the order loop.
+    """
+
+    def __init__(self, event):
+        self.event = event
+        self._order_ids = []
+
+    def add(self, order_id):
+        self._order_ids.append(order_id)
+        if len(self._order_ids) >= conf.ORDER_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._order_ids:
+            send_order_signals.apply_async(
+                args=(self.event.pk, self.event.organizer_id, self._order_ids),
+                queue=conf.SIGNAL_QUEUE,
+            )
+            self._order_ids = []
+
+
+@app.task
+def send_order_signals(event_id, organizer_id, order_ids):
+    with scope(organizer=Organizer.objects.get(id=organizer_id)):
+        event = Event.objects.get(id=event_id)
+        orders = list(event.orders.filter(pk__in=order_ids))
+        for order in orders:
+            order_placed.send(event, order=order)
+            if order.status == Order.STATUS_PAID:
+                order_paid.send(event, order=order)
+        bulk_orders_placed.send(event, orders=orders)
+
+
+class InvoicePDFBatch:
+    """
+    Collects the invoices of a run that were created without their PDF and renders
+    them once the orders are placed, split into at most
+    ``conf.INVOICE_PDF_CONCURRENCY`` tasks that work through their share in parallel.
+    Chunked runs pass the ``invoice_ids`` of their chunks on to the summary, which
+    renders the invoices of the whole run at once.
+    """
+
+    def __init__(self, invoice_ids=()):
+        self.invoice_ids = list(invoice_ids)
+
+    def add(self, invoice_id):
+        self.invoice_ids.append(invoice_id)
+
+    def flush(self):
+        if self.invoice_ids:
+            size = -(-len(self.invoice_ids) // conf.INVOICE_PDF_CONCURRENCY)
+            invoice_pdf_task.chunks([(i,) for i in self.invoice_ids], size).apply_async()
+            self.invoice_ids = []
 
 
 @app.task
-def process_orders(product_id, recipients, event_id, user_id, organizer_id):
+def send_order_mails(event_id, organizer_id, order_ids):
+    """
+    Sends the notification mails of ``order_ids``. All these tasks together send at
+    most ``conf.MAIL_RATE_LIMIT`` mails, see ``MailPacer``. The limit counts mails
+    rather than tasks, so it does not depend on ``conf.MAIL_BATCH_SIZE``. The task
+    waits for its turn to send each mail, so ``conf.MAIL_QUEUE`` should be a queue
+    of its own that keeps these waits away from the workers of pretix' mail queue.
+    """
+    pace = MailPacer(conf.MAIL_RATE_LIMIT)
+    with scope(organizer=Organizer.objects.get(id=organizer_id)):
+        ctx = BulkOrderContext(Event.objects.get(id=event_id))
+        orders = ctx.event.orders.filter(pk__in=order_ids).order_by("locale")
+        for locale, group in groupby(orders, key=lambda o: o.locale):
+            with language(locale, ctx.region):
+                for order in group:
+                    _send_order_mails(ctx, order, order.payments.last(), order.invoices.last(), pace)
+
+
+@app.task(queue=conf.BULK_QUEUE, acks_late=True, reject_on_worker_lost=True)
+def process_orders(product_id, recipients, event_id, user_id, organizer_id, job_id=None, options=None):
     """
     Extracted from pretix/api/view/orders.py
     Modified to handle custom built jsons and celery integration.
+
+    ``options`` holds the settings of the run chosen in the form, e.g. ``defer_mails``
+    to queue the notification mails instead of sending them from the order loop.
+
+    Recipients that already got their order in an earlier attempt of the same job are
+    skipped, so the task can safely be delivered again. Orders the earlier attempt did
+    not get to post-process are post-processed first, see ``_catch_up``.
     """
     # Celery doesnt support tasks with non-serializable objects.
     # We need to fetch the passed objects from their ids.
-    user = get_user_model().objects.get(id=user_id)
+    user = get_user_model().objects.filter(id=user_id).first()
     with scope(organizer=Organizer.objects.get(id=organizer_id)):
         event = Event.objects.get(id=event_id)
-        # For each order:
-        n = len(recipients)
-        i = 1
-        for customer in recipients:
-            i = i + 1
-            # for some reason namedtuple casts to list ->  [email, number, name, tag]
-            customer_name = customer[2]
-            customer_email = customer[0]
-            if len(customer_name) == 0:
-                customer_name = "blank"
-            data = {
-                "email": customer_email,
-                "locale": "fr",
-                "sales_channel": "web",
-                "positions": [
-                    {
-                        "item": product_id,
-                        "attendee_name": customer_name,
-                        "attendee_email": customer_email,
-                    }
-                ],
-                "payment_provider": "free",
-                "send_email": True,
-            }
-            serializer = OrderCreateSerializer(data=data, context={"event": event})
-            serializer.is_valid(raise_exception=True)
-            with transaction.atomic():
-                serializer.save()
-                send_mail = serializer._send_mail
-                order = serializer.instance
-                prefetch_related_objects(
-                    [order],
-                    Prefetch(
-                        "positions",
-                        OrderPosition.objects.all().prefetch_related(
-                            Prefetch("checkins", queryset=Checkin.objects.all()),
-                            "item",
-                            "variation",
-                            Prefetch(
-                                "answers",
-                                queryset=QuestionAnswer.objects.prefetch_related(
-                                    "options", "question"
-                                ).order_by("question__position"),
-                            ),
-                            "seat",
-                        ),
-                    ),
-                )
-                serializer = OrderSerializer(
-                    order,
-                    context={
-                        **serializer.context,
-                        "pdf_data": True,
-                        "include": [],
-                        "exclude": [],
-                    },
-                )
-                order.log_action(
-                    "pretix.event.order.placed",
-                    user=user if user.is_authenticated else None,
-                    auth=None,
-                )
+        options = options or {}
+        mails = MailBatch(event) if options.get("defer_mails") else None
+        pdfs = InvoicePDFBatch() if options.get("defer_invoice_pdfs") else None
+        signals = SignalBatch(event) if options.get("defer_signals") else None
+        progress = JobProgress(job_id)
+        progress.start()
+        try:
+            ctx = BulkOrderContext(event, user, product_id)
+            done = progress.completed_rows(0, count_recipients(recipients))
+            ctx.validate(count_tickets(recipients, done))
+            _catch_up(ctx, progress, 0, count_recipients(recipients), mails, pdfs, signals)
+            for batch in _batches(load_recipients(recipients, event.settings.locales), done):
+                results = _place_batch(ctx, batch, job_id, fast=options.get("fast_path", False))
+                placed = []
+                for locale, group in _locale_groups(ctx, results):
+                    with language(locale, ctx.region):
+                        for key, customer, order, send_mail, error in group:
+                            if error is not None:
+                                progress.failure(key, customer.get("row", key + 1), customer["email"], error)
+                                continue
+                            if order is None:
+                                continue
+                            progress.success()
+                            _order_placed(ctx, order, send_mail, mails, pdfs, signals)
+                            placed.append(key)
+                _notified(progress, placed, mails, signals)
+        except Exception as e:
+            progress.abort(e)
+            raise
+        finally:
+            if mails:
+                mails.flush()
+            if pdfs:
+                pdfs.flush()
+            if signals:
+                signals.flush()
+        _save_timings(ctx, progress)
+        progress.finish()
+        _log_timings(job_id, ctx.timer.summary())
 
-            with language(order.locale, event.settings.region):
-                payment = order.payments.last()
-                order_placed.send(event, order=order)
-                if order.status == Order.STATUS_PAID:
-                    order_paid.send(event, order=order)
-                    order.log_action(
-                        "pretix.event.order.paid",
-                        {
-                            "provider": payment.provider if payment else None,
-                            "info": {},
-                            "date": now().isoformat(),
-                            "force": False,
-                        },
-                        user=user if user.is_authenticated else None,
-                        auth=None,
-                    )
 
-                gen_invoice = (
-                        invoice_qualified(order)
-                        and (
-                                (order.event.settings.get("invoice_generate") == "True")
-                                or (
-                                        order.event.settings.get("invoice_generate") == "paid"
-                                        and order.status == Order.STATUS_PAID
-                                )
-                        )
-                        and not order.invoices.last()
-                )
-                invoice = None
-                if gen_invoice:
-                    invoice = generate_invoice(order, trigger_pdf=True)
-
-                if send_mail:
-                    free_flow = (
-                            payment
-                            and order.total == Decimal("0.00")
-                            and order.status == Order.STATUS_PAID
-                            and not order.require_approval
-                            and payment.provider in ("free", "boxoffice")
+@app.task(bind=True, queue=conf.BULK_QUEUE, max_retries=3, default_retry_delay=30, acks_late=True,
+          reject_on_worker_lost=True)
+def process_orders_chunk(self, product_id, recipients, event_id, user_id, organizer_id, job_id=None, options=None,
+                         start=0, created=0, failed=0, invoices=()):
+    """
+    Creates the orders for one slice of a bulk run, ``start`` being the offset of the
+    slice in the full recipient list.
+
+    Orders are committed in batches. If placing an order fails with anything but a
+    validation error, its batch is rolled back and the task is retried with only the
+    recipients that have not been committed yet. Recipients that already got their
+    order in an earlier attempt are skipped as well, so orders that were already
+    committed are never created twice, but their post-processing is caught up on if the
+    earlier attempt did not finish it. Once the retries are used up, the recipient is
+    counted as failed and the chunk moves on. An error that still stops the chunk
+    marks the whole job as failed.
+    """
+    try:
+        user = get_user_model().objects.filter(id=user_id).first()
+        with scope(organizer=Organizer.objects.get(id=organizer_id)):
+            event = Event.objects.get(id=event_id)
+            ctx = BulkOrderContext(event, user, product_id)
+            mails = MailBatch(event) if (options or {}).get("defer_mails") else None
+            pdfs = InvoicePDFBatch(invoices) if (options or {}).get("defer_invoice_pdfs") else None
+            signals = SignalBatch(event) if (options or {}).get("defer_signals") else None
+            progress = JobProgress(job_id)
+            progress.start()
+            done = progress.completed_rows(start, count_recipients(recipients))
+            _catch_up(ctx, progress, start, count_recipients(recipients), mails, pdfs, signals)
+            can_retry = self.request.retries < self.max_retries
+            for batch in _batches(load_recipients(recipients, event.settings.locales), done, start):
+                try:
+                    results = _place_batch(
+                        ctx, batch, job_id, catch=ValidationError if can_retry else Exception,
+                        fast=(options or {}).get("fast_path", False),
                     )
-                    if order.require_approval:
-                        email_template = (
-                            event.settings.mail_text_order_placed_require_approval
-                        )
-                        subject_template = (
-                            event.settings.mail_subject_order_placed_require_approval
-                        )
-                        log_entry = "pretix.event.order.email.order_placed_require_approval"
-                        email_attendees = False
-                    elif free_flow:
-                        email_template = event.settings.mail_text_order_free
-                        subject_template = event.settings.mail_subject_order_free
-                        log_entry = "pretix.event.order.email.order_free"
-                        email_attendees = event.settings.mail_send_order_free_attendee
-                        email_attendees_template = (
-                            event.settings.mail_text_order_free_attendee
-                        )
-                        subject_attendees_template = (
-                            event.settings.mail_subject_order_free_attendee
-                        )
-                    else:
-                        email_template = event.settings.mail_text_order_placed
-                        subject_template = event.settings.mail_subject_order_placed
-                        log_entry = "pretix.event.order.email.order_placed"
-                        email_attendees = event.settings.mail_send_order_placed_attendee
-                        email_attendees_template = (
-                            event.settings.mail_text_order_placed_attendee
-                        )
-                        subject_attendees_template = (
-                            event.settings.mail_subject_order_placed_attendee
-                        )
-
-                    _order_placed_email(
-                        event,
-                        order,
-                        email_template,
-                        subject_template,
-                        log_entry,
-                        invoice,
-                        [payment] if payment else [],
-                        is_free=free_flow,
+                except Exception as e:
+                    if not can_retry:
+                        raise
+                    progress.flush()
+                    if mails:
+                        mails.flush()
+                    if signals:
+                        signals.flush()
+                    i = batch[0][0] - start
+                    raise self.retry(
+                        args=(product_id, slice_recipients(recipients, i), event_id, user_id, organizer_id),
+                        kwargs={
+                            "job_id": job_id, "options": options, "start": start + i, "created": created,
+                            "failed": failed, "invoices": pdfs.invoice_ids if pdfs else [],
+                        },
+                        exc=e,
                     )
-                    if email_attendees:
-                        for p in order.positions.all():
-                            if (
-                                    p.addon_to_id is None
-                                    and p.attendee_email
-                                    and p.attendee_email != order.email
-                            ):
-                                _order_placed_email_attendee(
-                                    event,
-                                    order,
-                                    p,
-                                    email_attendees_template,
-                                    subject_attendees_template,
-                                    log_entry,
-                                    is_free=free_flow,
-                                )
-
-                    if not free_flow and order.status == Order.STATUS_PAID and payment:
-                        payment._send_paid_mail(invoice, None, "")
-                        if event.settings.mail_send_order_paid_attendee:
-                            for p in order.positions.all():
-                                if (
-                                        p.addon_to_id is None
-                                        and p.attendee_email
-                                        and p.attendee_email != order.email
-                                ):
-                                    payment._send_paid_mail_attendee(p, None)
+
+                placed = []
+                for locale, group in _locale_groups(ctx, results):
+                    with language(locale, ctx.region):
+                        for key, customer, order, send_mail, error in group:
+                            if error is not None:
+                                progress.failure(key, customer.get("row", key + 1), customer["email"], error)
+                                failed += 1
+                                continue
+                            if order is None:
+                                continue
+                            created += 1
+                            progress.success()
+                            # The order is committed at this point, a failure here must not cause it to be created
+                            # again.
+                            try:
+                                _order_placed(ctx, order, send_mail, mails, pdfs, signals)
+                            except Exception:
+                                logger.exception("Post-processing of automated order %s failed", order.code)
+                                continue
+                            placed.append(key)
+                _notified(progress, placed, mails, signals)
+            progress.flush()
+            if mails:
+                mails.flush()
+            if signals:
+                signals.flush()
+            _save_timings(ctx, progress)
+            progress.chunk_done()
+    except Retry:
+        raise
+    except Exception as e:
+        # Once a chunk fails for good, the chord never calls the summary that would finish the job.
+        with scopes_disabled():
+            progress = JobProgress(job_id)
+            progress.abort(e)
+            progress.chunk_done()
+        raise
+    # The PDFs are rendered by the summary, so a run takes no more than conf.INVOICE_PDF_CONCURRENCY tasks for
+    # them, however many chunks it has.
+    return {"created": created, "failed": failed, "invoices": pdfs.invoice_ids if pdfs else []}
+
+
+@app.task(queue=conf.BULK_QUEUE)
+def process_orders_summary(results, event_id, user_id, organizer_id, job_id=None):
+    user = get_user_model().objects.filter(id=user_id).first()
+    with scope(organizer=Organizer.objects.get(id=organizer_id)):
+        event = Event.objects.get(id=event_id)
+        InvoicePDFBatch(i for r in results for i in r.get("invoices", [])).flush()
+        JobProgress(job_id).finish()
+        if conf.TIMINGS and job_id is not None:
+            _log_timings(job_id, BulkOrderJob.objects.get(pk=job_id).timings)
+        event.log_action(
+            "pretix_automated_orders.bulk.finished",
+            data={
+                "chunks": len(results),
+                "created": sum(r["created"] for r in results),
+                "failed": sum(r["failed"] for r in results),
+            },
+            user=user,
+        )
+
+
+def process_orders_chunked(product_id, recipients, event_id, user_id, organizer_id, chunk_size, job_id=None,
+                           options=None, start_at=None, spread=None):
+    """
+    Splits the recipients into chunks of ``chunk_size`` which are processed in parallel
+    by all available workers, followed by a summary once every chunk is done.
+
+    The chunks start at ``start_at`` if given. With a ``spread`` timedelta, their
+    starts are distributed evenly over that window instead, so a large run does not
+    hit the database and the mail relay all at once.
+    """
+    slices = split_recipients(recipients, chunk_size)
+    chunks = []
+    for n, chunk_recipients in enumerate(slices):
+        chunk = process_orders_chunk.s(
+            product_id, chunk_recipients, event_id, user_id, organizer_id, job_id=job_id, options=options,
+            start=n * chunk_size
+        )
+        if start_at or spread:
+            chunk.set(eta=(start_at or now()) + (spread * n / len(slices) if spread else timedelta(0)))
+        chunks.append(chunk)
+    with scopes_disabled():
+        JobProgress(job_id).start_chunks(len(chunks))
+    return chord(chunks)(process_orders_summary.s(event_id, user_id, organizer_id, job_id=job_id))
+
+
+@app.task(bind=True, queue=conf.BULK_QUEUE, max_retries=None, acks_late=True, reject_on_worker_lost=True)
+def start_bulk_job(self, product_id, recipients, event_id, user_id, organizer_id, job_id, chunk_size=None,
+                   options=None, spread=None):
+    """
+    Starts a bulk run once no other run of the same event is in progress and the
+    organizer is below its limit of concurrent runs, see ``JobProgress.acquire``.
+    Until then, the job stays pending and the task is tried again every
+    ``conf.JOB_RETRY_DELAY`` seconds. Once started, the run is validated again and
+    the job fails if, e.g., the quota no longer has room for it.
+
+    Large runs are split into chunks of ``chunk_size``, whose starts are spread over
+    ``spread`` seconds if given.
+
+    The job is marked as dispatched once the tasks that create the orders are queued.
+    A delivery that finds the job started but not dispatched, because the worker of
+    an earlier one died in between, queues them again. They skip the recipients that
+    already got their order, so queuing them twice does no harm either.
+    """
+    with scope(organizer=Organizer.objects.get(id=organizer_id)):
+        if not JobProgress(job_id).acquire():
+            job = BulkOrderJob.objects.get(pk=job_id)
+            if job.status == BulkOrderJob.STATUS_PENDING:
+                raise self.retry(countdown=conf.JOB_RETRY_DELAY)
+            if job.status != BulkOrderJob.STATUS_RUNNING or job.dispatched:
+                # Started by an earlier delivery of this task.
+                return
+        # The run was checked when it was submitted, but other orders may have used up the quota while it waited.
+        user = get_user_model().objects.filter(id=user_id).first()
+        try:
+            BulkOrderContext(Event.objects.get(id=event_id), user, product_id).validate(count_tickets(recipients))
+        except DjangoValidationError as e:
+            JobProgress(job_id).abort(e)
+            return
+    args = (product_id, recipients, event_id, user_id, organizer_id)
+    if chunk_size and (count_recipients(recipients) > chunk_size or spread):
+        process_orders_chunked(
+            *args, chunk_size=chunk_size, job_id=job_id, options=options,
+            spread=timedelta(seconds=spread) if spread else None,
+        )
+    else:
+        process_orders.apply_async(args=args, kwargs={"job_id": job_id, "options": options})
+    with scopes_disabled():
+        BulkOrderJob.objects.filter(pk=job_id).update(dispatched=True)
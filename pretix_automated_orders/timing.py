@@ -0,0 +1,109 @@
+import time
+from contextlib import nullcontext
+
+from pretix.base.metrics import Counter
+
+# Upper bounds in seconds of the histogram buckets a stage's durations are sorted into.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float("inf"))
+
+_noop = nullcontext()
+
+stage_seconds = Counter(
+    "pretix_automated_orders_stage_seconds_total",
+    "Time spent in each stage of automated bulk orders", ["stage"]
+)
+stage_calls = Counter(
+    "pretix_automated_orders_stage_calls_total",
+    "Number of times each stage of automated bulk orders ran", ["stage"]
+)
+
+
+class _Stage:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, self.start)
+
+
+class StageTimer:
+    """
+    Adds up how long each stage of a bulk run takes into a histogram per stage.
+
+    A disabled timer hands out a shared no-op context manager and ignores
+    ``record``, so the instrumentation costs next to nothing when it is turned off.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._stages = {}
+
+    def stage(self, name):
+        if not self.enabled:
+            return _noop
+        return _Stage(self, name)
+
+    def clock(self):
+        return time.perf_counter() if self.enabled else None
+
+    def record(self, name, start):
+        """
+        Records the time since ``start``, a value returned by ``clock``, for the
+        stage ``name``.
+        """
+        if not self.enabled:
+            return
+        duration = time.perf_counter() - start
+        s = self._stages.get(name)
+        if s is None:
+            s = self._stages[name] = {"count": 0, "total": 0.0, "min": duration, "max": duration,
+                                      "buckets": [0] * len(BUCKETS)}
+        s["count"] += 1
+        s["total"] += duration
+        s["min"] = min(s["min"], duration)
+        s["max"] = max(s["max"], duration)
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                s["buckets"][i] += 1
+                break
+
+    def summary(self):
+        return {
+            name: dict(s, buckets=dict(zip((str(b) for b in BUCKETS), s["buckets"])))
+            for name, s in self._stages.items()
+        }
+
+    def export_metrics(self):
+        """
+        Adds the recorded stages to the counters that pretix serves on its metrics
+        endpoint.
+        """
+        for name, s in self._stages.items():
+            stage_seconds.inc(s["total"], stage=name)
+            stage_calls.inc(s["count"], stage=name)
+
+
+def merge_summaries(a, b):
+    """
+    Combines two results of ``StageTimer.summary``, e.g. of the chunks of one job.
+    """
+    merged = dict(a)
+    for name, s in b.items():
+        if name not in merged:
+            merged[name] = s
+            continue
+        m = merged[name]
+        merged[name] = {
+            "count": m["count"] + s["count"],
+            "total": m["total"] + s["total"],
+            "min": min(m["min"], s["min"]),
+            "max": max(m["max"], s["max"]),
+            "buckets": {k: m["buckets"].get(k, 0) + s["buckets"].get(k, 0) for k in set(m["buckets"]) | set(s["buckets"])},
+        }
+    return merged
@@ -1,11 +1,20 @@
 from django.urls import re_path as url
 
-from . import views
+from pretix.api.urls import event_router
+
+from . import api, views
 
 urlpatterns = [
     url(
-        r"^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/automated_orders/",
+        r"^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/automated_orders/$",
         views.OrderBulkCreateView.as_view(),
         name="index",
     ),
+    url(
+        r"^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/automated_orders/jobs/(?P<job>\d+)/$",
+        views.BulkOrderJobStatusView.as_view(),
+        name="job.status",
+    ),
 ]
+
+event_router.register(r"automated_orders", api.BulkOrderJobViewSet)
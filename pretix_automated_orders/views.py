@@ -1,11 +1,20 @@
+from datetime import timedelta
+
 from django.contrib import messages
-from django.shortcuts import reverse, redirect
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404, reverse, redirect
+from django.utils.timezone import now
 from django.utils.translation import gettext as _
+from django.views import View
 from django.views.generic.edit import FormView
 from pretix.control.permissions import EventPermissionRequiredMixin
 from pretix.base.models import Item
+from .context import BulkOrderContext
 from .forms import AutomatedBulkOrdersForm
-from .tasks import process_orders
+from .models import BulkOrderJob
+from .planning import plan_run
+from .recipients import count_recipients, recipient_dicts, store_recipient_file
+from .tasks import start_bulk_job
 
 """
 Pretix Order creator plugin
@@ -21,19 +30,71 @@ the async stuff.
 """
 
 
+def _spread(form):
+    if form.cleaned_data.get("spread_minutes"):
+        return timedelta(minutes=form.cleaned_data["spread_minutes"])
+    return None
+
+
+def start_bulk_run(form, event, user, task=start_bulk_job):
+    """
+    Creates the job for a validated ``AutomatedBulkOrdersForm`` and queues the run.
+    ``user`` may be anonymous if the run was started with an API token. Returns
+    the job.
+    """
+    product = form.cleaned_data["product"]
+    separate_orders = form.cleaned_data.get("number_mode") == "orders"
+    upload = form.cleaned_data.get("send_recipients_file")
+    start_at = form.cleaned_data.get("scheduled_start")
+    spread = _spread(form)
+    if upload:
+        recipients = store_recipient_file(
+            upload,
+            form.file_tickets if separate_orders else form.file_rows,
+            form.file_tickets,
+            separate_orders=separate_orders,
+            keep_until=(start_at or now()) + (spread or timedelta(0)),
+        )
+    else:
+        recipients = list(recipient_dicts(form.cleaned_data["send_recipients"], separate_orders=separate_orders))
+    user = user if user.is_authenticated else None
+    job = BulkOrderJob.objects.create(event=event, user=user, total=count_recipients(recipients), spread=spread)
+    options = {
+        "defer_mails": form.cleaned_data.get("defer_mails", False),
+        "defer_invoice_pdfs": form.cleaned_data.get("defer_invoice_pdfs", False),
+        "defer_signals": form.cleaned_data.get("defer_signals", False),
+        "fast_path": form.cleaned_data.get("fast_path", False),
+    }
+    task.apply_async(
+        args=(product.id, recipients, event.id, user.id if user else None, event.organizer.id, job.pk),
+        kwargs={
+            "chunk_size": form.cleaned_data.get("chunk_size"),
+            "options": options,
+            "spread": spread.total_seconds() if spread else None,
+        },
+        eta=start_at,
+    )
+    return job
+
+
 class OrderBulkCreateView(EventPermissionRequiredMixin, FormView):
     form_class = AutomatedBulkOrdersForm
     template_name = "automated_orders/index.html"
     permission = "can_change_orders"
-    task = process_orders
+    task = start_bulk_job
 
     def get(self, request, *args, **kwargs):
         """Handle GET requests: instantiate a blank version of the form."""
         return self.render_to_response(self.get_context_data())
 
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ctx["jobs"] = BulkOrderJob.objects.filter(event=self.request.event)[:5]
+        return ctx
+
     def get_success_url(self, value=None) -> str:
         return reverse(
-            "control:event.orders",
+            "plugins:pretix_automated_orders:index",
             kwargs={
                 "organizer": self.request.event.organizer.slug,
                 "event": self.request.event.slug,
@@ -50,10 +111,9 @@ class OrderBulkCreateView(EventPermissionRequiredMixin, FormView):
         )
 
     def form_valid(self, form):
-        product = form.cleaned_data["product"]
-        recipients = form.cleaned_data["send_recipients"]
-        self.task.apply_async(
-            args=(product.id, recipients, self.request.event.id, self.request.user.id, self.request.event.organizer.id))
+        if "dry_run" in self.request.POST:
+            return self.dry_run(form)
+        start_bulk_run(form, self.request.event, self.request.user, task=self.task)
         messages.add_message(
             self.request,
             messages.INFO,
@@ -61,6 +121,27 @@ class OrderBulkCreateView(EventPermissionRequiredMixin, FormView):
         )
         return redirect(self.get_success_url())
 
+    def dry_run(self, form):
+        """
+        Shows what the run would create and how long it would probably take instead of
+        starting it. The form already validated every recipient and the quota, nothing
+        is stored.
+        """
+        separate_orders = form.cleaned_data.get("number_mode") == "orders"
+        if form.cleaned_data.get("send_recipients_file"):
+            orders = form.file_tickets if separate_orders else form.file_rows
+            tickets = form.file_tickets
+        else:
+            recipients = form.cleaned_data["send_recipients"]
+            tickets = sum(r.number for r in recipients)
+            orders = tickets if separate_orders else len(recipients)
+        ctx = BulkOrderContext(self.request.event, product_id=form.cleaned_data["product"].pk)
+        plan = plan_run(
+            ctx, orders, tickets, chunk_size=form.cleaned_data.get("chunk_size"),
+            start_at=form.cleaned_data.get("scheduled_start"), spread=_spread(form),
+        )
+        return self.render_to_response(self.get_context_data(form=form, plan=plan))
+
     def get_form_kwargs(self):
         return {**super().get_form_kwargs(), "event": self.request.event}
 
@@ -68,3 +149,25 @@ class OrderBulkCreateView(EventPermissionRequiredMixin, FormView):
         return _(
             "There was an error while sending orders via e-mail. Some orders might have been sent."
         )
+
+
+class BulkOrderJobStatusView(EventPermissionRequiredMixin, View):
+    permission = "can_view_orders"
+
+    def get(self, request, *args, **kwargs):
+        job = get_object_or_404(BulkOrderJob, event=request.event, pk=kwargs["job"])
+        return JsonResponse(
+            {
+                "id": job.pk,
+                "status": job.status,
+                "total": job.total,
+                "succeeded": job.succeeded,
+                "failed": job.failed,
+                "percentage": job.percentage,
+                "done": job.is_done,
+                "created": job.created.isoformat(),
+                "started": job.started.isoformat() if job.started else None,
+                "finished": job.finished.isoformat() if job.finished else None,
+                "errors": list(reversed(job.errors.order_by("-pk").values("row", "email", "error")[:20])),
+            }
+        )
@@ -0,0 +1,91 @@
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.core.cache import cache
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Organizer, Team, User
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmarks", action="store_true", help="Run the benchmarks, see test_benchmark.py.")
+
+
+def pytest_collection_modifyitems(config, items):
+    # The benchmarks take a while and check wall-clock times, which only mean something on a quiet machine.
+    if config.getoption("--benchmarks"):
+        return
+    skip = pytest.mark.skip(reason="Benchmarks only run with --benchmarks.")
+    for item in items:
+        if "benchmarks" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def locmem_cache(settings):
+    settings.CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    # Local memory caches outlive the settings, the ids of the test objects repeat between tests.
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.fixture
+def organizer():
+    return Organizer.objects.create(name="Dummy", slug="dummy")
+
+
+@pytest.fixture
+def event(organizer):
+    with scopes_disabled():
+        return Event.objects.create(
+            organizer=organizer,
+            name="Dummy",
+            slug="dummy",
+            date_from=now() + timedelta(days=10),
+            plugins="pretix_automated_orders",
+        )
+
+
+@pytest.fixture
+def user(organizer, event):
+    user = User.objects.create_user("dummy@dummy.dummy", "dummy")
+    with scopes_disabled():
+        team = Team.objects.create(
+            organizer=organizer, can_change_orders=True, can_view_orders=True, can_change_event_settings=True
+        )
+        team.members.add(user)
+        team.limit_events.add(event)
+    return user
+
+
+@pytest.fixture
+def item(event):
+    with scopes_disabled():
+        return event.items.create(name="Free ticket", default_price=Decimal("0.00"))
+
+
+@pytest.fixture
+def quota(event, item):
+    with scopes_disabled():
+        quota = event.quotas.create(name="Tickets", size=100)
+        quota.items.add(item)
+        return quota
+
+
+@pytest.fixture
+def recipients():
+    """
+    Returns a function that builds a list of recipient dicts like the ones the form
+    hands to the tasks.
+    """
+
+    def build(count, prefix="r", number=1):
+        return [
+            {"email": "{}{}@example.org".format(prefix, i), "number": number, "name": "Name {}".format(i),
+             "tag": None, "row": i + 1, "locale": None}
+            for i in range(count)
+        ]
+
+    return build
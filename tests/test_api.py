@@ -0,0 +1,129 @@
+import json
+import re
+
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django_scopes import scopes_disabled
+from rest_framework.test import APIClient
+
+from pretix_automated_orders.models import BulkOrderJob, BulkOrderJobError, BulkOrderJobRow
+
+URL = "/api/v1/organizers/dummy/events/dummy/automated_orders/"
+
+
+@pytest.fixture
+def api_client(user):
+    with scopes_disabled():
+        token = user.teams.get().tokens.create(name="Test")
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION="Token " + token.token)
+    return client
+
+
+def _page(api_client, url):
+    response = api_client.get(url)
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+    link = re.match(r"<(.*)>; rel=\"next\"", response.get("Link", ""))
+    return lines, link.group(1) if link else None, response["X-Job-Status"]
+
+
+@pytest.mark.django_db
+def test_create_and_page_results(api_client, event, item, quota, recipients):
+    response = api_client.post(URL, {
+        "product": item.pk,
+        "recipients": [{"email": r["email"], "name": r["name"]} for r in recipients(5)],
+    }, format="json")
+    assert response.status_code == 202
+    job_id = response.data["id"]
+
+    url, pages = "{}{}/results/?limit=2".format(URL, job_id), []
+    while url:
+        lines, url, status = _page(api_client, url)
+        pages.append([(line["type"], line["position"], line["email"]) for line in lines])
+    assert status == BulkOrderJob.STATUS_FINISHED
+    assert pages == [
+        [("order", 0, "r0@example.org"), ("order", 1, "r1@example.org")],
+        [("order", 2, "r2@example.org"), ("order", 3, "r3@example.org")],
+        [("order", 4, "r4@example.org")],
+    ]
+
+
+@pytest.mark.django_db
+def test_create_rejects_unknown_fields(api_client, event, item, quota):
+    response = api_client.post(URL, {
+        "product": item.pk, "recipients": [{"email": "a@example.org", "lang": "de"}],
+    }, format="json")
+    assert response.status_code == 400
+    assert response.data["send_recipients"] == ['CSV input contains an unknown field with the header "lang".']
+    with scopes_disabled():
+        assert not BulkOrderJob.objects.exists()
+
+
+@pytest.mark.django_db
+def test_create_with_recipient_objects(api_client, event, item, quota):
+    event.settings.locales = ["en", "de"]
+    response = api_client.post(URL, {
+        "product": item.pk,
+        "recipients": [
+            {"email": "a@example.org", "name": "A, B", "number": 2, "locale": "DE"}, {"email": "b@example.org"},
+        ],
+    }, format="json")
+    assert response.status_code == 202
+    with scopes_disabled():
+        orders = {o.email: o for o in event.orders.all()}
+        assert (orders["a@example.org"].locale, orders["a@example.org"].positions.count()) == ("de", 2)
+        assert orders["a@example.org"].positions.first().attendee_name == "A, B"
+        assert orders["b@example.org"].positions.count() == 1
+
+
+@pytest.mark.django_db
+def test_uploaded_file_locales(api_client, event, item, quota):
+    event.settings.locales = ["en", "de"]
+    csv = "email,locale\n{p}a@example.org,DE\n{p}b@example.org,En\n{p}c@example.org,\n"
+    response = api_client.post(URL, {"product": item.pk, "send_recipients": csv.format(p="text-")}, format="json")
+    assert response.status_code == 202
+    response = api_client.post(URL, {
+        "product": item.pk,
+        "send_recipients_file": SimpleUploadedFile("recipients.csv", csv.format(p="file-").encode(), "text/csv"),
+    }, format="multipart")
+    assert response.status_code == 202
+    with scopes_disabled():
+        locales = dict(event.orders.values_list("email", "locale"))
+    # The worker reads the file again and spells the locales like the form does for entered recipients.
+    assert locales == {
+        "{}{}@example.org".format(p, r): locale
+        for p in ("text-", "file-") for r, locale in (("a", "de"), ("b", "en"), ("c", "en"))
+    }
+
+
+@pytest.mark.django_db
+def test_results_of_running_job(api_client, event):
+    with scopes_disabled():
+        job = BulkOrderJob.objects.create(event=event, status=BulkOrderJob.STATUS_RUNNING, total=5)
+        # The chunk with the third recipient has not committed yet, a later one has.
+        for position in (0, 1, 3):
+            BulkOrderJobRow.objects.create(job=job, row=position)
+        BulkOrderJobError.objects.create(job=job, position=4, row=5, email="e@example.org", error="Sold out")
+
+    lines, url, status = _page(api_client, "{}{}/results/".format(URL, job.pk))
+    assert [(line["type"], line["position"]) for line in lines] == [("order", 0), ("order", 1)]
+    assert status == BulkOrderJob.STATUS_RUNNING
+
+    lines, url, status = _page(api_client, url)
+    assert lines == []
+
+    with scopes_disabled():
+        BulkOrderJobError.objects.create(job=job, position=2, row=3, email="c@example.org", error="Invalid")
+    lines, url, status = _page(api_client, url)
+    assert [(line["type"], line["position"], line.get("row")) for line in lines] == [
+        ("error", 2, 3), ("order", 3, None), ("error", 4, 5),
+    ]
+
+    with scopes_disabled():
+        BulkOrderJobError.objects.create(job=job, error="Worker lost")
+        BulkOrderJob.objects.filter(pk=job.pk).update(status=BulkOrderJob.STATUS_FAILED)
+    lines, url, status = _page(api_client, url)
+    assert [(line["type"], line["position"], line["error"]) for line in lines] == [("error", None, "Worker lost")]
+    assert url is None
+    assert status == BulkOrderJob.STATUS_FAILED
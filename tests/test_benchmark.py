@@ -0,0 +1,91 @@
+"""
+Benchmarks of the bulk order pipeline. Run them with
+
+    python -m pytest tests/test_benchmark.py --benchmarks --benchmark-json=results.json
+
+to get the timings together with the queries per order and the peak memory of each
+case as JSON, e.g. to compare a pretix upgrade or a plugin release with the version
+before. Without ``--benchmarks``, they are skipped.
+"""
+import tracemalloc
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_scopes import scope, scopes_disabled
+
+from pretix_automated_orders import conf
+from pretix_automated_orders.forms import AutomatedBulkOrdersForm
+from pretix_automated_orders.tasks import process_orders
+
+pytestmark = pytest.mark.benchmarks
+
+PARSE_ROWS = (1000, 10000, 100000)
+# Seconds checking a list of 100000 recipients may take at most, including the lookup of existing orders.
+PARSE_100K_SECONDS = 1.0
+ORDERS = 50
+BATCH_SIZES = (1, 10, 50)
+
+
+def _peak_memory(fn, *args):
+    """
+    Returns the peak of the memory allocated by Python while ``fn`` runs, in kilobytes.
+    Measured on its own, since tracing allocations slows the code down.
+    """
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("rows", PARSE_ROWS)
+def test_parse_recipients(benchmark, event, rows):
+    raw = "email,name,number\n" + "".join(
+        "recipient{i}@example.org,Recipient {i},1\n".format(i=i) for i in range(rows)
+    )
+
+    def parse():
+        with scope(organizer=event.organizer):
+            form = AutomatedBulkOrdersForm(data={"send_recipients": raw}, event=event)
+            form.cleaned_data = {"send_recipients": raw}
+            return form.clean_send_recipients()
+
+    parsed = benchmark.pedantic(parse, rounds=3)
+    assert len(parsed) == rows
+    benchmark.extra_info["rows"] = rows
+    benchmark.extra_info["peak_memory_kb"] = _peak_memory(parse)
+    # The best of the rounds, which is the least disturbed by other processes. Without timings, e.g. with
+    # --benchmark-disable, there is nothing to check.
+    if rows == 100000 and benchmark.stats:
+        assert benchmark.stats.stats.min < PARSE_100K_SECONDS
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("fast_path", (False, True))
+@pytest.mark.parametrize("batch_size", BATCH_SIZES)
+def test_process_orders(benchmark, monkeypatch, event, user, item, quota, recipients, batch_size, fast_path):
+    monkeypatch.setattr(conf, "ORDER_BATCH_SIZE", batch_size)
+    with scopes_disabled():
+        quota.size = None
+        quota.save()
+    runs = iter(range(100))
+    queries = []
+
+    def setup():
+        return (recipients(ORDERS, prefix="run{}-".format(next(runs))),), {}
+
+    def run(recipient_list):
+        with CaptureQueriesContext(connection) as ctx:
+            process_orders.apply(
+                args=(item.pk, recipient_list, event.pk, user.pk, event.organizer_id),
+                kwargs={"options": {"fast_path": fast_path}},
+            ).get()
+        queries.append(len(ctx))
+
+    benchmark.pedantic(run, setup=setup, rounds=1)
+    benchmark.extra_info["orders"] = ORDERS
+    benchmark.extra_info["queries_per_order"] = queries[0] / ORDERS
+    benchmark.extra_info["peak_memory_kb"] = _peak_memory(run, *setup()[0])
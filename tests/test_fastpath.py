@@ -0,0 +1,121 @@
+import pytest
+from django_scopes import scope, scopes_disabled
+from pretix.base.models import LogEntry, Order, OrderPosition, Transaction
+
+from pretix_automated_orders import tasks
+from pretix_automated_orders.context import BulkOrderContext
+from pretix_automated_orders.models import BulkOrderJob, BulkOrderJobRow
+
+# Fields that are generated for every order anew or that hold the recipient, which is compared separately.
+ORDER_EXCLUDE = {"id", "code", "email", "secret", "internal_secret", "datetime", "last_modified", "expires"}
+POSITION_EXCLUDE = {
+    "id", "order_id", "secret", "web_secret", "pseudonymization_id", "attendee_email", "attendee_name_cached",
+    "attendee_name_parts",
+}
+PAYMENT_EXCLUDE = {"id", "order_id", "created", "payment_date"}
+TRANSACTION_EXCLUDE = {"id", "order_id", "created", "datetime"}
+
+
+def _fields(instance, exclude):
+    return {f.attname: getattr(instance, f.attname) for f in instance._meta.concrete_fields if f.attname not in exclude}
+
+
+def _snapshot(order):
+    return (
+        _fields(order, ORDER_EXCLUDE),
+        [_fields(p, POSITION_EXCLUDE) for p in order.all_positions.order_by("positionid")],
+        [_fields(p, PAYMENT_EXCLUDE) for p in order.payments.order_by("local_id")],
+        [_fields(t, TRANSACTION_EXCLUDE) for t in Transaction.objects.filter(order=order).order_by("id")],
+        sorted(LogEntry.objects.filter(object_id=order.pk, content_type__model="order").values_list(
+            "action_type", flat=True
+        )),
+    )
+
+
+@pytest.fixture
+def create_orders_calls(monkeypatch):
+    calls = []
+    create_orders = tasks.create_orders
+
+    def spy(ctx, prototype, items, job_id=None):
+        calls.append(len(items))
+        return create_orders(ctx, prototype, items, job_id)
+
+    monkeypatch.setattr(tasks, "create_orders", spy)
+    return calls
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("number", [1, 3])
+def test_same_orders_as_serializer(event, user, item, quota, recipients, create_orders_calls, number):
+    regular = recipients(5, prefix="regular", number=number)
+    fast = recipients(5, prefix="fast", number=number)
+    tasks.process_orders.apply(args=(item.pk, regular, event.pk, user.pk, event.organizer_id)).get()
+    assert create_orders_calls == []
+    tasks.process_orders.apply(
+        args=(item.pk, fast, event.pk, user.pk, event.organizer_id), kwargs={"options": {"fast_path": True}}
+    ).get()
+    # The first order of the run is the prototype, the others are copies of it.
+    assert create_orders_calls == [4]
+
+    with scopes_disabled():
+        expected = _snapshot(Order.objects.get(email=regular[0]["email"]))
+        for r in regular + fast:
+            order = Order.objects.get(email=r["email"])
+            assert _snapshot(order) == expected
+            assert [(p.attendee_name, p.attendee_email) for p in order.positions.all()] == [
+                (r["name"], r["email"])
+            ] * number
+
+
+@pytest.mark.django_db
+def test_codes_and_secrets_unique(event, user, item, quota, recipients, create_orders_calls):
+    tasks.process_orders.apply(
+        args=(item.pk, recipients(20, number=2), event.pk, user.pk, event.organizer_id),
+        kwargs={"options": {"fast_path": True}},
+    ).get()
+    assert create_orders_calls
+    with scopes_disabled():
+        orders = list(Order.objects.all())
+        positions = list(OrderPosition.all.all())
+    assert len(orders) == 20 and len(positions) == 40
+    for values in (
+        [o.code for o in orders],
+        [o.secret for o in orders],
+        [o.internal_secret for o in orders],
+        [p.secret for p in positions],
+        [p.web_secret for p in positions],
+        [p.pseudonymization_id for p in positions],
+    ):
+        assert len(set(values)) == len(values)
+
+
+@pytest.mark.django_db
+def test_quota_shortfall_falls_back(event, user, item, quota, recipients, create_orders_calls):
+    quota.size = 4
+    quota.save()
+    batch = list(enumerate(recipients(6)))
+    with scope(organizer=event.organizer):
+        ctx = BulkOrderContext(event, user, item.pk)
+        results = tasks._place_batch(ctx, batch, fast=True)
+        assert create_orders_calls == [5]
+        assert [order is not None for key, customer, order, send_mail, error in results] == [True] * 4 + [False] * 2
+        assert all(error is not None for key, customer, order, send_mail, error in results[4:])
+        assert Order.objects.count() == 4
+
+
+@pytest.mark.django_db
+def test_existing_job_row_falls_back(event, user, item, quota, recipients, create_orders_calls):
+    with scopes_disabled():
+        job = BulkOrderJob.objects.create(event=event, total=6)
+        BulkOrderJobRow.objects.create(job=job, row=3)
+    batch = list(enumerate(recipients(6)))
+    with scope(organizer=event.organizer):
+        ctx = BulkOrderContext(event, user, item.pk)
+        results = tasks._place_batch(ctx, batch, job_id=job.pk, fast=True)
+        assert create_orders_calls == [5]
+        assert [(key, order is not None, error) for key, customer, order, send_mail, error in results] == [
+            (0, True, None), (1, True, None), (2, True, None), (3, False, None), (4, True, None), (5, True, None),
+        ]
+        assert Order.objects.count() == 5
+        assert set(Order.objects.values_list("email", flat=True)) == {r["email"] for k, r in batch if k != 3}
@@ -0,0 +1,83 @@
+from io import StringIO
+
+import pytest
+from django.core.exceptions import ValidationError
+from django.utils.timezone import now
+from django_scopes import scope
+from pretix.base.models import Item, Order
+
+from pretix_automated_orders.forms import AutomatedBulkOrdersForm, eligible_item_choices, existing_order_emails
+from pretix_automated_orders.recipients import RecipientValidator
+
+
+@pytest.fixture
+def orders(event):
+    with scope(organizer=event.organizer):
+        for email, status in (
+            ("paid@example.org", Order.STATUS_PAID),
+            ("Pending@Example.org", Order.STATUS_PENDING),
+            ("canceled@example.org", Order.STATUS_CANCELED),
+            ("expired@example.org", Order.STATUS_EXPIRED),
+        ):
+            Order.objects.create(
+                event=event, email=email, status=status, total=0, datetime=now(), expires=now(),
+                sales_channel=event.organizer.sales_channels.get(identifier="web"),
+            )
+
+
+@pytest.mark.django_db
+def test_existing_order_emails(event, orders):
+    with scope(organizer=event.organizer):
+        assert existing_order_emails(event, [
+            "paid@example.org", "PAID@example.org", "pending@example.org", "Pending@Example.org",
+            "canceled@example.org", "expired@example.org", "new@example.org",
+        ]) == {"paid@example.org", "pending@example.org"}
+
+
+@pytest.mark.django_db
+def test_validator_looks_up_batches(event, orders, django_assert_num_queries):
+    raw = "email,name\n" + "".join(
+        "{},Name\n".format(e) for e in (
+            "a@example.org", "paid@example.org", "b@example.org", "invalid", "canceled@example.org",
+            "Pending@Example.org", "c@example.org",
+        )
+    )
+    validator = RecipientValidator(existing_emails=lambda emails: existing_order_emails(event, emails))
+    validator.lookup_batch_size = 2
+    with scope(organizer=event.organizer):
+        # Six valid rows in batches of two.
+        with django_assert_num_queries(3):
+            recipients = list(validator.iter(StringIO(raw)))
+    assert [r.email for r in recipients] == ["a@example.org", "b@example.org", "canceled@example.org", "c@example.org"]
+    with pytest.raises(ValidationError) as e:
+        validator.raise_errors()
+    assert e.value.messages == [
+        "Row 2: paid@example.org already has an order for this event.",
+        "Row 4: invalid is not a valid email address.",
+        "Row 6: Pending@Example.org already has an order for this event.",
+    ]
+
+
+@pytest.mark.django_db
+def test_product_choices_cached(event, item, locmem_cache, django_assert_num_queries):
+    with scope(organizer=event.organizer):
+        Item.objects.create(event=event, name="Paid ticket", default_price=10)
+        str(AutomatedBulkOrdersForm(event=event)["product"])
+        with django_assert_num_queries(0):
+            rendered = str(AutomatedBulkOrdersForm(event=event)["product"])
+        assert "Free ticket" in rendered and "Paid ticket" not in rendered
+
+        # Saving a product drops the cached choices.
+        Item.objects.create(event=event, name="Second free ticket", default_price=0)
+        assert [name for pk, name in eligible_item_choices(event)] == ["Free ticket", "Second free ticket"]
+
+        form = AutomatedBulkOrdersForm(data={"product": item.pk}, event=event)
+        form.is_valid()
+        assert "product" not in form.errors
+
+
+@pytest.mark.django_db
+def test_form_without_event():
+    form = AutomatedBulkOrdersForm()
+    assert eligible_item_choices(None) == []
+    assert list(form.fields["product"].choices) == [("", "---------")]
@@ -0,0 +1,82 @@
+import socket
+import time
+
+import pytest
+from aiosmtpd.controller import Controller
+from django_scopes import scopes_disabled
+from pretix.base.models import Order
+
+from pretix_automated_orders import conf, tasks
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.received = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received.append((time.monotonic(), envelope.rcpt_tos))
+        return "250 OK"
+
+
+@pytest.fixture
+def smtp_server(settings):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    settings.EMAIL_BACKEND = settings.EMAIL_CUSTOM_SMTP_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+    settings.EMAIL_HOST = "127.0.0.1"
+    settings.EMAIL_PORT = port
+    settings.EMAIL_USE_TLS = settings.EMAIL_USE_SSL = False
+    yield handler
+    controller.stop()
+
+
+def _place_orders(event, user, item, recipients):
+    tasks.process_orders.apply(args=(item.pk, recipients, event.pk, user.pk, event.organizer_id)).get()
+    with scopes_disabled():
+        return list(Order.objects.order_by("pk").values_list("pk", flat=True))
+
+
+# pretix hands mails to its mail task once the transaction commits, which only happens right away outside
+# of the test transaction.
+@pytest.mark.django_db(transaction=True)
+def test_rate_limit_counts_mails(
+    event, user, item, quota, recipients, smtp_server, monkeypatch
+):
+    order_ids = _place_orders(event, user, item, recipients(5))
+    # Leave out the mails sent while placing the orders.
+    smtp_server.received.clear()
+    monkeypatch.setattr(conf, "MAIL_RATE_LIMIT", "10/s")
+    tasks.send_order_mails.apply(args=(event.pk, event.organizer_id, order_ids)).get()
+
+    assert sorted(rcpt for t, rcpt in smtp_server.received) == [[r["email"]] for r in recipients(5)]
+    times = [t for t, rcpt in smtp_server.received]
+    # One task with five mails at ten mails a second takes at least 0.4 seconds from the first to the last.
+    assert max(times) - min(times) >= 0.4 - 0.05
+
+
+@pytest.mark.django_db(transaction=True)
+def test_no_rate_limit(
+    event, user, item, quota, recipients, smtp_server, monkeypatch
+):
+    order_ids = _place_orders(event, user, item, recipients(5))
+    # Leave out the mails sent while placing the orders.
+    smtp_server.received.clear()
+    monkeypatch.setattr(conf, "MAIL_RATE_LIMIT", None)
+    start = time.monotonic()
+    tasks.send_order_mails.apply(args=(event.pk, event.organizer_id, order_ids)).get()
+    assert len(smtp_server.received) == 5
+    assert time.monotonic() - start < 0.4
+
+
+def test_rate_limit_shared_between_tasks(locmem_cache):
+    first, second = tasks.MailPacer("10/s"), tasks.MailPacer("10/s")
+    times = []
+    for pace in (first, second, first, second):
+        pace()
+        times.append(time.time())
+    # Two tasks sending two mails each take turns at ten mails a second.
+    assert all(b - a >= 0.1 - 0.02 for a, b in zip(times, times[1:]))
@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+import pytest
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+
+from pretix_automated_orders.models import BulkOrderJob
+from pretix_automated_orders.planning import recent_rates
+
+
+def _finished_job(event, orders, seconds, spread=None):
+    started = now() - timedelta(hours=1)
+    return BulkOrderJob.objects.create(
+        event=event, status=BulkOrderJob.STATUS_FINISHED, total=orders, succeeded=orders, started=started,
+        finished=started + timedelta(seconds=seconds), spread=spread,
+    )
+
+
+@pytest.mark.django_db
+def test_recent_rates_leave_out_spread_runs(event):
+    with scopes_disabled():
+        assert recent_rates(event) == (None, None, 0)
+        _finished_job(event, 100, 50)
+        _finished_job(event, 300, 250)
+        # Mostly waiting for the chunks of the window to start.
+        _finished_job(event, 100, 3600, spread=timedelta(minutes=55))
+        assert recent_rates(event) == (0.75, None, 2)
@@ -0,0 +1,99 @@
+import codecs
+
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django_scopes import scopes_disabled
+from pretix.base.models import Order
+
+from pretix_automated_orders import tasks
+from pretix_automated_orders.models import BulkOrderJob
+from pretix_automated_orders.recipients import (
+    RecipientValidator, count_tickets, load_recipients, split_recipients, store_recipient_file,
+)
+
+# A byte order mark, a quoted line break, blank lines and more than one ticket per row.
+CSV = codecs.BOM_UTF8 + (
+    'email,name,number\r\n'
+    'a@example.org,"Ä\r\nB",2\r\n'
+    '\r\n'
+    'b@example.org,B,1\r\n'
+    'c@example.org,C,3\r\n'
+    '\r\n'
+    'd@example.org,D,1\r\n'
+    'e@example.org,É,2\r\n'
+).encode()
+
+
+def _store(content, separate_orders):
+    validator = RecipientValidator(allow_duplicates=True)
+    recipients = list(validator.iter(codecs.getreader("utf-8-sig")(SimpleUploadedFile("r.csv", content))))
+    tickets = sum(r.number for r in recipients)
+    return store_recipient_file(
+        SimpleUploadedFile("r.csv", content, "text/csv"), tickets if separate_orders else len(recipients), tickets,
+        separate_orders=separate_orders,
+    )
+
+
+@pytest.fixture
+def parsed_rows(monkeypatch):
+    """
+    Counts the rows the validator checks.
+    """
+    counter = []
+    check = RecipientValidator._check
+
+    def counting(self, *args):
+        counter.append(args[0])
+        return check(self, *args)
+
+    monkeypatch.setattr(RecipientValidator, "_check", counting)
+    return counter
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("separate_orders", (False, True))
+@pytest.mark.parametrize("size", (1, 2, 4))
+def test_split_file_reads_own_rows(event, parsed_rows, separate_orders, size):
+    recipients = _store(CSV, separate_orders)
+    expected = list(load_recipients(recipients))
+    assert len(expected) == recipients["count"]
+    parsed_rows.clear()
+
+    slices = split_recipients(recipients, size)
+    # One pass over the file to find the offsets of the chunks.
+    assert len(parsed_rows) == 5
+    parsed_rows.clear()
+    assert [list(load_recipients(s)) for s in slices] == [
+        expected[i:i + size] for i in range(0, len(expected), size)
+    ]
+    # Every chunk starts at the row of its first recipient, so a row is only read twice if its orders are split
+    # between two chunks.
+    assert len(parsed_rows) <= 5 + (len(slices) - 1 if separate_orders else 0)
+
+
+@pytest.mark.django_db
+def test_count_tickets_of_file(event, parsed_rows):
+    recipients = _store(CSV, False)
+    parsed_rows.clear()
+    assert count_tickets(recipients) == 9
+    assert parsed_rows == []
+    # Leaving out positions of a resumed run needs the tickets of every row.
+    assert count_tickets(recipients, skip={0, 2}) == 4
+
+
+@pytest.mark.django_db
+def test_chunked_run_from_file(event, user, item, quota):
+    recipients = _store(CSV, True)
+    with scopes_disabled():
+        job = BulkOrderJob.objects.create(event=event, total=recipients["count"])
+    tasks.process_orders_chunked(item.pk, recipients, event.pk, user.pk, event.organizer_id, 2, job_id=job.pk)
+    with scopes_disabled():
+        job.refresh_from_db()
+        assert (job.status, job.succeeded) == (BulkOrderJob.STATUS_FINISHED, 9)
+        assert sorted(job.rows.values_list("row", flat=True)) == list(range(9))
+        assert sorted(Order.objects.values_list("email", flat=True)) == sorted(
+            ["a@example.org"] * 2 + ["b@example.org"] + ["c@example.org"] * 3 + ["d@example.org"] + ["e@example.org"] * 2
+        )
+        assert {p.attendee_name for o in Order.objects.filter(email="a@example.org") for p in o.positions.all()} == {
+            "Ä\r\nB"
+        }
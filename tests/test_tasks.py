@@ -0,0 +1,314 @@
+from datetime import timedelta
+
+import pytest
+from django.db import OperationalError
+from django.utils.timezone import now
+from django_scopes import scope, scopes_disabled
+from pretix.base.models import Item, Order
+from rest_framework.exceptions import ValidationError
+
+from pretix_automated_orders import conf, tasks
+from pretix_automated_orders.context import BulkOrderContext
+from pretix_automated_orders.models import BulkOrderJob, BulkOrderJobRow
+from pretix_automated_orders.progress import JobProgress
+
+# Queries for one free order with one ticket once the run is warmed up: creating the order, its log entries, the
+# order_placed and order_paid signals and the notification mail, which the test settings send right away. Measured
+# with pretix' test settings on SQLite.
+QUERIES_PER_ORDER = 56
+
+
+@pytest.mark.django_db
+def test_queries_per_order(event, user, item, quota, recipients, django_assert_num_queries):
+    first, second = recipients(2)
+
+    def place(key, customer):
+        for key, customer, order, send_mail, error in tasks._place_batch(ctx, [(key, customer)]):
+            assert error is None
+            tasks._order_placed(ctx, order, send_mail)
+
+    with scope(organizer=event.organizer):
+        ctx = BulkOrderContext(event, user, item.pk)
+        # The first order fills the caches of the run, e.g. the validated order data.
+        place(0, first)
+        with django_assert_num_queries(QUERIES_PER_ORDER):
+            place(1, second)
+        assert Order.objects.count() == 2
+
+
+@pytest.fixture
+def job(event):
+    with scopes_disabled():
+        return BulkOrderJob.objects.create(event=event, total=4)
+
+
+@pytest.mark.django_db
+def test_failed_chunk_fails_job(event, user, item, quota, recipients, job, monkeypatch):
+    def fail(*args, **kwargs):
+        raise OperationalError("server closed the connection unexpectedly")
+
+    monkeypatch.setattr(tasks, "_place_batch", fail)
+    with pytest.raises(OperationalError):
+        tasks.process_orders_chunked(item.pk, recipients(4), event.pk, user.pk, event.organizer_id, 2, job_id=job.pk)
+    job.refresh_from_db()
+    assert job.status == BulkOrderJob.STATUS_FAILED
+    assert job.finished is not None
+    with scopes_disabled():
+        assert "server closed the connection unexpectedly" in job.errors.values_list("error", flat=True)
+
+
+@pytest.mark.django_db
+def test_chunk_setup_failure_fails_job(event, user, item, quota, recipients, job):
+    with pytest.raises(Item.DoesNotExist):
+        tasks.process_orders_chunked(
+            item.pk + 1, recipients(4), event.pk, user.pk, event.organizer_id, 2, job_id=job.pk
+        )
+    job.refresh_from_db()
+    assert job.status == BulkOrderJob.STATUS_FAILED
+
+
+@pytest.mark.django_db
+def test_flush_inserts_errors(event, job):
+    with scopes_disabled():
+        progress = JobProgress(job.pk, flush_every=2)
+        progress.success()
+        progress.failure(0, 1, "a@example.org", "Sold out")
+        progress.failure(1, 2, "b@example.org", "Invalid email")
+        progress.flush()
+        job.refresh_from_db()
+        assert (job.succeeded, job.failed) == (1, 2)
+        assert list(job.errors.values_list("position", "row", "email", "error")) == [
+            (0, 1, "a@example.org", "Sold out"), (1, 2, "b@example.org", "Invalid email"),
+        ]
+
+
+@pytest.mark.django_db
+def test_start_fails_job_without_quota(event, user, item, quota, recipients, job, monkeypatch):
+    # The run was valid when it was submitted, then the quota was sold while it waited for its turn.
+    quota.size = 2
+    quota.save()
+    dispatched = []
+    monkeypatch.setattr(tasks.process_orders, "apply_async", lambda *args, **kwargs: dispatched.append(kwargs))
+    tasks.start_bulk_job.apply(args=(item.pk, recipients(4), event.pk, user.pk, event.organizer_id, job.pk)).get()
+    with scopes_disabled():
+        job.refresh_from_db()
+        assert job.status == BulkOrderJob.STATUS_FAILED
+        assert [e.row for e in job.errors.all()] == [None]
+        assert "There is only quota for 2 of 4 tickets" in job.errors.get().error
+        assert not Order.objects.exists()
+    assert dispatched == []
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("dispatched", (False, True))
+def test_start_redelivery_dispatches_once(event, user, item, quota, recipients, job, monkeypatch, dispatched):
+    # An earlier delivery started the job, and its worker died before or after queuing the order task.
+    with scopes_disabled():
+        BulkOrderJob.objects.filter(pk=job.pk).update(status=BulkOrderJob.STATUS_RUNNING, dispatched=dispatched)
+    queued = []
+    monkeypatch.setattr(tasks.process_orders, "apply_async", lambda *args, **kwargs: queued.append(kwargs))
+    args = (item.pk, recipients(4), event.pk, user.pk, event.organizer_id, job.pk)
+    tasks.start_bulk_job.apply(args=args).get()
+    tasks.start_bulk_job.apply(args=args).get()
+    assert [q["kwargs"]["job_id"] for q in queued] == ([] if dispatched else [job.pk])
+    job.refresh_from_db()
+    assert (job.status, job.dispatched) == (BulkOrderJob.STATUS_RUNNING, True)
+
+
+@pytest.mark.django_db
+def test_resume_notifies_missed_orders(event, user, item, quota, recipients, job, mailoutbox):
+    recipient_list = recipients(4)
+    tasks.process_orders.apply(args=(item.pk, recipient_list, event.pk, user.pk, event.organizer_id, job.pk)).get()
+    with scopes_disabled():
+        assert job.rows.filter(notified=True).count() == 4
+        # The worker died after committing rows 1 and 2, before their mails went out.
+        job.rows.filter(row__in=(1, 2)).update(notified=False)
+        BulkOrderJob.objects.filter(pk=job.pk).update(status=BulkOrderJob.STATUS_RUNNING)
+    mailoutbox.clear()
+
+    tasks.process_orders.apply(args=(item.pk, recipient_list, event.pk, user.pk, event.organizer_id, job.pk)).get()
+    with scopes_disabled():
+        assert Order.objects.count() == 4
+        assert job.rows.filter(notified=True).count() == 4
+        job.refresh_from_db()
+        assert job.status == BulkOrderJob.STATUS_FINISHED
+    assert sorted(m.to[0] for m in mailoutbox) == [recipient_list[1]["email"], recipient_list[2]["email"]]
+
+
+@pytest.mark.django_db
+def test_failed_order_rolls_back_alone(event, user, item, quota, recipients, job, monkeypatch):
+    monkeypatch.setattr(conf, "ORDER_BATCH_SIZE", 4)
+    create_row = BulkOrderJobRow.objects.create
+
+    def create(**kwargs):
+        # Fails after the order is written, which its savepoint has to undo.
+        if kwargs["row"] == 1:
+            raise ValidationError("Rejected")
+        return create_row(**kwargs)
+
+    monkeypatch.setattr(BulkOrderJobRow.objects, "create", create)
+    recipient_list = recipients(4)
+    tasks.process_orders.apply(args=(item.pk, recipient_list, event.pk, user.pk, event.organizer_id, job.pk)).get()
+    with scopes_disabled():
+        job.refresh_from_db()
+        assert (job.status, job.succeeded, job.failed) == (BulkOrderJob.STATUS_FINISHED, 3, 1)
+        assert list(job.errors.values_list("position", "row", "email")) == [(1, 2, recipient_list[1]["email"])]
+        assert sorted(Order.objects.values_list("email", flat=True)) == sorted(
+            r["email"] for i, r in enumerate(recipient_list) if i != 1
+        )
+        assert sorted(job.rows.values_list("row", flat=True)) == [0, 2, 3]
+
+
+@pytest.mark.django_db
+def test_invoice_pdfs_rendered_once_per_run(event, user, item, quota, recipients, job, monkeypatch):
+    # Free orders get no invoice, so every order pretends to have one with the order's id.
+    order_placed = tasks._order_placed
+
+    def placed(ctx, order, send_mail, mails=None, pdfs=None, signals=None):
+        order_placed(ctx, order, send_mail, mails, pdfs, signals)
+        pdfs.add(order.pk)
+
+    renders = []
+
+    class RenderTask:
+        def chunks(self, args, size):
+            renders.append([[i for i, in args[n:n + size]] for n in range(0, len(args), size)])
+            return self
+
+        def apply_async(self):
+            pass
+
+    monkeypatch.setattr(tasks, "_order_placed", placed)
+    monkeypatch.setattr(tasks, "invoice_pdf_task", RenderTask())
+    monkeypatch.setattr(conf, "INVOICE_PDF_CONCURRENCY", 2)
+    tasks.process_orders_chunked(
+        item.pk, recipients(6), event.pk, user.pk, event.organizer_id, 2, job_id=job.pk,
+        options={"defer_invoice_pdfs": True},
+    )
+    with scopes_disabled():
+        order_ids = sorted(Order.objects.values_list("pk", flat=True))
+    # Three chunks, but one dispatch for the whole run, split into two tasks.
+    assert len(renders) == 1
+    assert len(renders[0]) == 2
+    assert sorted(i for task in renders[0] for i in task) == order_ids
+
+
+class SignalRecorder:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, sender, **kwargs):
+        self.sent.append(kwargs)
+        return []
+
+
+@pytest.mark.django_db
+def test_deferred_signals(event, user, item, quota, recipients, job, monkeypatch):
+    monkeypatch.setattr(conf, "ORDER_BATCH_SIZE", 2)
+    placed, paid, bulk = SignalRecorder(), SignalRecorder(), SignalRecorder()
+    monkeypatch.setattr(tasks, "order_placed", placed)
+    monkeypatch.setattr(tasks, "order_paid", paid)
+    monkeypatch.setattr(tasks, "bulk_orders_placed", bulk)
+    queued = []
+    monkeypatch.setattr(tasks.send_order_signals, "apply_async", lambda args, queue: queued.append((args, queue)))
+
+    tasks.process_orders.apply(
+        args=(item.pk, recipients(5), event.pk, user.pk, event.organizer_id, job.pk),
+        kwargs={"options": {"defer_signals": True}},
+    ).get()
+    # Nothing is sent from the order loop, the orders are queued in batches on the signal queue.
+    assert placed.sent == paid.sent == bulk.sent == []
+    assert [(len(args[2]), queue) for args, queue in queued] == [(2, conf.SIGNAL_QUEUE)] * 2 + [(1, conf.SIGNAL_QUEUE)]
+
+    for args, queue in queued:
+        tasks.send_order_signals.apply(args=args).get()
+    with scopes_disabled():
+        orders = set(Order.objects.all())
+    assert {s["order"] for s in placed.sent} == {s["order"] for s in paid.sent} == orders
+    assert [len(s["orders"]) for s in bulk.sent] == [2, 2, 1]
+
+
+def _running_job(event, reported, spread=None, status=BulkOrderJob.STATUS_RUNNING, chunks_pending=0):
+    return BulkOrderJob.objects.create(
+        event=event, status=status, total=10, started=now() - timedelta(hours=2),
+        updated=now() - reported, spread=spread, chunks_pending=chunks_pending,
+    )
+
+
+@pytest.mark.django_db
+def test_acquire_waits_for_spread_run(event, job):
+    with scopes_disabled():
+        # Quiet for longer than JOB_STALE_AFTER, but its last chunks are still waiting for their start.
+        spread = _running_job(event, timedelta(hours=1), spread=timedelta(hours=3))
+        assert not JobProgress(job.pk).acquire()
+        spread.refresh_from_db()
+        assert spread.status == BulkOrderJob.STATUS_RUNNING
+
+
+@pytest.mark.django_db
+def test_acquire_fails_stale_jobs(event, job, monkeypatch):
+    monkeypatch.setattr(conf, "JOB_STALE_AFTER", 1800)
+    with scopes_disabled():
+        dead = _running_job(event, timedelta(hours=1))
+        ended = _running_job(event, timedelta(hours=1), spread=timedelta(minutes=45))
+        alive = _running_job(event.organizer.events.create(
+            name="Other", slug="other", date_from=now(), plugins="pretix_automated_orders",
+        ), timedelta(minutes=5))
+        assert JobProgress(job.pk).acquire()
+        for j, status in ((dead, BulkOrderJob.STATUS_FAILED), (ended, BulkOrderJob.STATUS_FAILED),
+                          (alive, BulkOrderJob.STATUS_RUNNING), (job, BulkOrderJob.STATUS_RUNNING)):
+            j.refresh_from_db()
+            assert j.status == status
+        assert dead.finished is not None
+        assert list(dead.errors.values_list("row", flat=True)) == [None]
+
+
+@pytest.mark.django_db
+def test_acquire_waits_for_chunks_of_failed_job(event, job):
+    with scopes_disabled():
+        # One chunk failed the job, two others are still creating orders.
+        failed = _running_job(event, timedelta(minutes=1), status=BulkOrderJob.STATUS_FAILED, chunks_pending=2)
+        assert not failed.is_done
+        assert not JobProgress(job.pk).acquire()
+        JobProgress(failed.pk).chunk_done()
+        assert not JobProgress(job.pk).acquire()
+        JobProgress(failed.pk).chunk_done()
+        failed.refresh_from_db()
+        assert failed.is_done
+        assert JobProgress(job.pk).acquire()
+
+
+@pytest.mark.django_db
+def test_acquire_ends_chunks_of_stale_failed_job(event, job):
+    with scopes_disabled():
+        failed = _running_job(event, timedelta(hours=1), status=BulkOrderJob.STATUS_FAILED, chunks_pending=2)
+        assert JobProgress(job.pk).acquire()
+        failed.refresh_from_db()
+        assert (failed.status, failed.chunks_pending) == (BulkOrderJob.STATUS_FAILED, 0)
+
+
+@pytest.mark.django_db
+def test_failed_chunk_leaves_others_pending(event, user, item, quota, recipients, job, monkeypatch):
+    place_batch = tasks._place_batch
+
+    def fail_first_chunk(ctx, batch, *args, **kwargs):
+        if batch[0][0] < 2:
+            raise OperationalError("server closed the connection unexpectedly")
+        return place_batch(ctx, batch, *args, **kwargs)
+
+    monkeypatch.setattr(tasks, "_place_batch", fail_first_chunk)
+    monkeypatch.setattr(tasks.process_orders_chunk, "max_retries", 0)
+    chunks = []
+    monkeypatch.setattr(tasks, "chord", lambda signatures: chunks.extend(signatures) or (lambda summary: None))
+    tasks.process_orders_chunked(item.pk, recipients(6), event.pk, user.pk, event.organizer_id, 2, job_id=job.pk)
+    job.refresh_from_db()
+    assert job.chunks_pending == 3
+
+    with pytest.raises(OperationalError):
+        chunks[0].apply().get()
+    job.refresh_from_db()
+    assert (job.status, job.chunks_pending, job.is_done) == (BulkOrderJob.STATUS_FAILED, 2, False)
+    for chunk in chunks[1:]:
+        chunk.apply().get()
+    job.refresh_from_db()
+    assert (job.status, job.succeeded, job.chunks_pending, job.is_done) == (BulkOrderJob.STATUS_FAILED, 4, 0, True)